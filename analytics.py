@@ -0,0 +1,262 @@
+import datetime
+import math
+import threading
+import time
+from quote_dates import parse_timestamp
+
+"""
+Quote analytics. Quoted and approved value is kept in buckets per chemistry, battery type,
+brand and week (the Monday the quote was issued in), updated as quotes are issued, re-priced
+and approved, so a query only merges buckets and never reads quotes. Each bucket holds a
+histogram of battery prices with bins about HISTOGRAM_ACCURACY apart, which gives percentiles
+within that relative error and merges by adding counts.
+
+Each quote's contribution is kept so a re-priced quote can be taken out of its buckets and put
+back at its new price, and an approved quote added to the approved value. Contributions are also
+recorded in their own repository as quotes are issued and re-priced, and the aggregates are built
+from those (next to the quotes' approval) on the first query, so building never prices anything.
+"""
+
+DIMENSIONS = ("chemistry", "batteryType", "brand", "week")
+PERCENTILES = (50, 90, 99)
+HISTOGRAM_ACCURACY = 0.01
+GAMMA = (1 + HISTOGRAM_ACCURACY) / (1 - HISTOGRAM_ACCURACY)
+LOG_GAMMA = math.log(GAMMA)
+# bin of prices that are zero (or negative, which no config should produce)
+ZERO_BIN = -2**31
+
+def week_of(date):
+    day = parse_timestamp(date).date()
+    return (day - datetime.timedelta(days=day.weekday())).isoformat()
+
+def price_bin(price):
+    return math.ceil(math.log(price) / LOG_GAMMA) if price > 0 else ZERO_BIN
+
+# middle of the bin, within HISTOGRAM_ACCURACY of every price in it
+def bin_value(index):
+    return 0.0 if index == ZERO_BIN else 2 * GAMMA ** index / (GAMMA + 1)
+
+'''
+Bucket holds the aggregates of one chemistry, battery type, brand and week
+'''
+class Bucket:
+    __slots__ = ("batteries", "quotedValue", "approvedBatteries", "approvedValue", "bins")
+
+    def __init__(self):
+        self.batteries = 0
+        self.quotedValue = 0.0
+        self.approvedBatteries = 0
+        self.approvedValue = 0.0
+        self.bins = {}
+
+    def merge(self, other):
+        self.batteries += other.batteries
+        self.quotedValue += other.quotedValue
+        self.approvedBatteries += other.approvedBatteries
+        self.approvedValue += other.approvedValue
+        for index, count in other.bins.items():
+            self.bins[index] = self.bins.get(index, 0) + count
+
+    def percentiles(self):
+        total = sum(self.bins.values())
+        if not total:
+            return {f"p{p}": None for p in PERCENTILES}
+        bins = sorted(self.bins.items())
+        result = {}
+        seen, i = 0, 0
+        for p in PERCENTILES:
+            rank = p / 100 * (total - 1)
+            while seen + bins[i][1] <= rank:
+                seen += bins[i][1]
+                i += 1
+            result[f"p{p}"] = bin_value(bins[i][0])
+        return result
+
+    def to_dict(self):
+        return {
+            "batteries": self.batteries,
+            "quotedValue": self.quotedValue,
+            "approvedBatteries": self.approvedBatteries,
+            "approvedValue": self.approvedValue,
+            "batteryPrice": self.percentiles(),
+        }
+
+# (bucket key, price bin) -> [batteries, value] for the batteries of one quote
+def contribution(quote, batteries, prices):
+    week = week_of(quote["quoteIssuedDate"])
+    parts = {}
+    for battery, price in zip(batteries, prices):
+        key = (battery["chemistry"], battery["batteryType"], battery["brand"] or battery["vehicleMake"], week)
+        part = parts.setdefault((key, price_bin(price)), [0, 0.0])
+        part[0] += 1
+        part[1] += price
+    return tuple((key, index, count, value) for (key, index), (count, value) in parts.items())
+
+# a contribution as stored, one flat [chemistry, batteryType, brand, week, bin, batteries, value] list per part
+def encode_contribution(parts):
+    return [[*key, index, count, value] for key, index, count, value in parts]
+
+def decode_contribution(stored):
+    return tuple((tuple(part[:4]), part[4], part[5], part[6]) for part in stored)
+
+'''
+Aggregates are the buckets and the contribution of every quote in them
+'''
+class Aggregates:
+    def __init__(self):
+        self.buckets = {}
+        # quote id -> (approved?, contribution)
+        self.contributions = {}
+
+    def apply(self, parts, sign, approved):
+        for key, index, count, value in parts:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = Bucket()
+            bucket.batteries += sign * count
+            bucket.quotedValue += sign * value
+            bucket.bins[index] = bucket.bins.get(index, 0) + sign * count
+            if not bucket.bins[index]:
+                del bucket.bins[index]
+            if approved:
+                bucket.approvedBatteries += sign * count
+                bucket.approvedValue += sign * value
+
+    def replace(self, quote_id, approved, parts):
+        previous = self.contributions.get(quote_id)
+        if previous is not None:
+            self.apply(previous[1], -1, previous[0])
+        self.apply(parts, 1, approved)
+        self.contributions[quote_id] = (approved, parts)
+
+    def approve(self, quote_id):
+        recorded = self.contributions.get(quote_id)
+        if recorded is None or recorded[0]:
+            return
+        for key, index, count, value in recorded[1]:
+            bucket = self.buckets[key]
+            bucket.approvedBatteries += count
+            bucket.approvedValue += value
+        self.contributions[quote_id] = (True, recorded[1])
+
+'''
+QuoteAnalytics maintains the aggregates. contributions holds the recorded contribution of every
+quote, by quote id, and backfill(quote) returns (batteries, battery prices) for quotes issued
+before contributions were recorded, or None to leave the quote out. The aggregates are built
+outside the lock so quoting never waits for it: updates made meanwhile are recorded and replayed
+on the new aggregates. With repositories shared between processes other processes' quotes never
+reach this one, so once the aggregates are refresh_seconds old a query starts a rebuild in the
+background and answers from the current ones
+'''
+class QuoteAnalytics:
+    def __init__(self, quotes, contributions, backfill, refresh_seconds=60):
+        self.quotes = quotes
+        self.contributions = contributions
+        self.backfill = backfill
+        self.refresh_seconds = refresh_seconds
+        self.lock = threading.Lock()
+        # one build at a time
+        self.build_lock = threading.Lock()
+        self.aggregates = Aggregates()
+        # updates made while a build runs, None when none does
+        self.pending = None
+        self.built_at = None
+
+    # runs an update now, and again on the aggregates being built if there is a build
+    def update(self, method, *args):
+        with self.lock:
+            if self.built_at is not None:
+                getattr(self.aggregates, method)(*args)
+            if self.pending is not None:
+                self.pending.append((method, args))
+
+    # records a quote, or replaces what was recorded for it when it was re-priced. Until the
+    # first build the aggregates aren't tracked, the build reads the recorded contribution
+    def add_quote(self, quote, batteries, prices):
+        parts = contribution(quote, batteries, prices)
+        self.contributions[quote["id"]] = {"id": quote["id"], "parts": encode_contribution(parts)}
+        if self.built_at is None and self.pending is None:
+            return
+        self.update("replace", quote["id"], quote["isApproved"], parts)
+
+    def approve(self, quote_id):
+        if self.built_at is None and self.pending is None:
+            return
+        self.update("approve", quote_id)
+
+    # The quotes' records and contributions are written before add_quote or approve check for a
+    # build, so an update that was skipped because no build was running yet is read by the build
+    def build(self):
+        with self.build_lock:
+            with self.lock:
+                self.pending = []
+            try:
+                aggregates = Aggregates()
+                for quote, parts in self.recorded():
+                    aggregates.replace(quote["id"], quote["isApproved"], parts)
+            except BaseException:
+                with self.lock:
+                    self.pending = None
+                raise
+            with self.lock:
+                for method, args in self.pending:
+                    getattr(aggregates, method)(*args)
+                self.aggregates = aggregates
+                self.pending = None
+                self.built_at = time.monotonic()
+
+    # (quote, contribution) for every quote on record. Both repositories are scanned in id order
+    # side by side, and a quote without a recorded contribution is backfilled and recorded once
+    def recorded(self):
+        contributions = self.contributions.scan()
+        stored = next(contributions, None)
+        for quote in self.quotes.scan():
+            while stored is not None and stored["id"] < quote["id"]:
+                stored = next(contributions, None)
+            if stored is not None and stored["id"] == quote["id"]:
+                yield quote, decode_contribution(stored["parts"])
+                continue
+            priced = self.backfill(quote)
+            if priced is None:
+                continue
+            parts = contribution(quote, *priced)
+            self.contributions[quote["id"]] = {"id": quote["id"], "parts": encode_contribution(parts)}
+            yield quote, parts
+
+    def ensure_built(self):
+        built_at = self.built_at
+        if built_at is None:
+            with self.build_lock:
+                if self.built_at is not None:
+                    return
+            self.build()
+        elif self.quotes.shared and time.monotonic() - built_at >= self.refresh_seconds and not self.build_lock.locked():
+            threading.Thread(target=self.refresh, name="analytics-refresh", daemon=True).start()
+
+    def refresh(self):
+        if self.build_lock.locked() or time.monotonic() - self.built_at < self.refresh_seconds:
+            return
+        self.build()
+
+    # one group per distinct value of the group_by dimensions over the weeks from the one since
+    # falls in up to until (exclusive), sorted by those values
+    def query(self, group_by=(), since=None, until=None):
+        self.ensure_built()
+        since_week = week_of(since.isoformat()) if since else None
+        until = until.date().isoformat() if until else None
+        positions = [DIMENSIONS.index(d) for d in group_by]
+        groups = {}
+        with self.lock:
+            for key, bucket in self.aggregates.buckets.items():
+                week = key[3]
+                if (since_week and week < since_week) or (until and week >= until) or not bucket.batteries:
+                    continue
+                group = tuple(key[i] for i in positions)
+                merged = groups.get(group)
+                if merged is None:
+                    merged = groups[group] = Bucket()
+                merged.merge(bucket)
+        return [
+            {**dict(zip(group_by, group)), **groups[group].to_dict()}
+            for group in sorted(groups, key=lambda g: tuple((v is not None, v or "") for v in g))
+        ]
@@ -0,0 +1,152 @@
+from operator import attrgetter, itemgetter
+from quote_dates import parse_date, reference_now
+import records
+from quote_calculator import (
+    CHEMISTRY_SCORES,
+    BATTERY_TYPE_SCORES,
+    CONDITION_ORIGINALLY_PURCHASED_SCORES,
+    THRESHOLD_RULES,
+    PURCHASE_AGE_THRESHOLD_DAYS,
+)
+
+# numpy is optional, without it every pickup is priced by the scalar QuoteCalculator
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+"""
+Batch pricing prices all the batteries of a large pickup at once. The batteries are turned
+into columns (one array per property) and the compiled QuoteCalculator rules are applied to
+whole columns with numpy. Operations are applied in the same order as the scalar path so
+every battery gets exactly the same price as QuoteCalculator.calculate_battery_price.
+"""
+
+# the codes compact Battery records store, so their enum slots are column values as they are
+CHEMISTRIES = list(records.CHEMISTRIES)
+BATTERY_TYPES = list(records.BATTERY_TYPES)
+CONDITIONS = list(records.CONDITIONS)
+
+CHEMISTRY_CODES = {v: i for i, v in enumerate(CHEMISTRIES)}
+BATTERY_TYPE_CODES = {v: i for i, v in enumerate(BATTERY_TYPES)}
+CONDITION_CODES = {v: i for i, v in enumerate(CONDITIONS)}
+
+
+def is_available():
+    return np is not None
+
+def encode(values, codes):
+    # unknown values fail the same way the scalar lookup tables do
+    return np.fromiter((codes[v] for v in values), dtype=np.intp, count=len(values))
+
+def score_table(codes_order, scores):
+    return np.array([scores[v] for v in codes_order], dtype=np.float64)
+
+'''
+Columnar view of a list of batteries, built once and priced under any number of calculators
+'''
+class BatteryColumns:
+    def __init__(self, batteries):
+        self.size = len(batteries)
+        if all(type(b) is records.Battery for b in batteries):
+            try:
+                self.fill(batteries, attrgetter, lambda values, codes: np.array(values, dtype=np.intp))
+            except AttributeError as e:
+                raise KeyError(e.name) from None
+        else:
+            self.fill(batteries, itemgetter, encode)
+
+    # get(field) reads a field of a battery, encoded(values, codes) turns enum values into codes
+    def fill(self, batteries, get, encoded):
+        def column(k):
+            return list(map(get(k), batteries))
+        self.chemistry = encoded(column("chemistry"), CHEMISTRY_CODES)
+        self.batteryType = encoded(column("batteryType"), BATTERY_TYPE_CODES)
+        self.conditionOriginallyPurchased = encoded(column("conditionOriginallyPurchased"), CONDITION_CODES)
+        for k in THRESHOLD_RULES:
+            setattr(self, k, np.array(column(k), dtype=np.float64))
+        self.isFunctioning = np.array([bool(v) for v in column("isFunctioning")], dtype=bool)
+
+        # purchase dates repeat a lot in fleet pickups, so each distinct date is parsed once
+        date_codes = {}
+        self.purchase_date_index = np.fromiter(
+            (date_codes.setdefault(v, len(date_codes)) for v in column("dateOriginallyPurchased")),
+            dtype=np.intp, count=self.size)
+        self.purchase_dates = [parse_date(v) for v in date_codes]
+
+        # same brand/model fallbacks as QuoteCalculator.calculate_battery_base_price
+        model_codes = {}
+        self.model_index = np.fromiter(
+            (model_codes.setdefault((brand or make, model or vehicle_model), len(model_codes))
+                for brand, make, model, vehicle_model in zip(column("brand"), column("vehicleMake"), column("model"), column("vehicleModel"))),
+            dtype=np.intp, count=self.size)
+        self.models = list(model_codes)
+
+    def purchase_age_days(self, now):
+        ages = np.array([(now - d).days for d in self.purchase_dates], dtype=np.int64)
+        return ages[self.purchase_date_index]
+
+# raw property scores for the whole column, matching the scalar rules in quote_calculator
+def property_scores(columns, k, now):
+    match k:
+        case "chemistry":
+            return score_table(CHEMISTRIES, CHEMISTRY_SCORES)[columns.chemistry]
+        case "batteryType":
+            return score_table(BATTERY_TYPES, BATTERY_TYPE_SCORES)[columns.batteryType]
+        case "conditionOriginallyPurchased":
+            return score_table(CONDITIONS, CONDITION_ORIGINALLY_PURCHASED_SCORES)[columns.conditionOriginallyPurchased]
+        case "dateOriginallyPurchased":
+            return np.where(columns.purchase_age_days(now) < PURCHASE_AGE_THRESHOLD_DAYS, 0.9, 0.5)
+        case "isFunctioning":
+            return np.where(columns.isFunctioning, 0.9, 0.2)
+    greater_than, threshold, passed, failed = THRESHOLD_RULES[k]
+    values = getattr(columns, k)
+    return np.where(values > threshold if greater_than else values < threshold, passed, failed)
+
+# property_cache keeps the property scores of these columns at now, for pricing them under several calculators
+def battery_scores(calculator, columns, now=None, property_cache=None):
+    now = reference_now(now)
+    property_cache = {} if property_cache is None else property_cache
+    scores = np.zeros(columns.size, dtype=np.float64)
+    for k, _, adjusted_weight in calculator.weighted_rules:
+        if k not in property_cache:
+            property_cache[k] = property_scores(columns, k, now)
+        scores += property_cache[k] * adjusted_weight
+    return scores
+
+def battery_base_prices(calculator, columns):
+    msrps = calculator.battery_model_MSRPs
+    model_prices = np.full(len(columns.models), np.nan)
+    for i, (brand, model) in enumerate(columns.models):
+        brand_MSRPs = msrps.get(brand)
+        if brand_MSRPs is not None and model in brand_MSRPs:
+            model_prices[i] = brand_MSRPs[model]
+    prices = model_prices[columns.model_index]
+
+    per_kWh = np.isnan(prices)
+    if per_kWh.any():
+        cost_per_kWh = np.array([calculator.battery_chemistry_cost_per_kWh.get(c, np.nan) for c in CHEMISTRIES])
+        kWh_prices = cost_per_kWh[columns.chemistry] * columns.markedCapacitykWh
+        missing = per_kWh & np.isnan(kWh_prices)
+        if missing.any():
+            raise KeyError(CHEMISTRIES[columns.chemistry[missing.argmax()]])
+        prices = np.where(per_kWh, kWh_prices, prices)
+    return prices
+
+def battery_prices(calculator, batteries, now=None):
+    now = reference_now(now)
+    columns = batteries if isinstance(batteries, BatteryColumns) else BatteryColumns(batteries)
+    return battery_scores(calculator, columns, now) * battery_base_prices(calculator, columns)
+
+# prices of the batteries under every calculator, one list per calculator. The columns and the
+# property scores are computed once and shared, only the weighting and base prices are per config
+def price_matrix(calculators, batteries, now=None):
+    now = reference_now(now)
+    columns = batteries if isinstance(batteries, BatteryColumns) else BatteryColumns(batteries)
+    property_cache = {}
+    return [(battery_scores(calculator, columns, now, property_cache) * battery_base_prices(calculator, columns)).tolist()
+        for calculator in calculators]
+
+# summed sequentially, like the scalar path, so the total matches to the last bit
+def final_quote_price(calculator, pickup, now=None):
+    return sum(battery_prices(calculator, pickup["batteries"], now).tolist())
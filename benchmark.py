@@ -0,0 +1,192 @@
+import argparse
+import itertools
+import json
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+
+"""
+In-process benchmarks for the quote hot path. Everything runs against the Flask test client, so
+no server is needed: `python benchmark.py > bench.json`. Results are printed as JSON with latency
+percentiles (milliseconds) and ops/sec for each benchmark, so runs can be compared before deploying.
+"""
+
+CHEMISTRIES = ["LiFePO4", "Li-ion", "NiCd", "NiMH"]
+BATTERY_TYPES = ["EV", "Home", "BatteryBackup"]
+CONDITIONS = ["New", "LikeNew", "Used"]
+WEIGHTED_PROPS = [
+    "chemistry",
+    "batteryType",
+    "weightLbs",
+    "inputVoltage",
+    "outputVoltage",
+    "markedCapacitykWh",
+    "approxLengthUsedDays",
+    "dateOriginallyPurchased",
+    "isFunctioning",
+    "conditionOriginallyPurchased",
+]
+
+'''
+SyntheticData generates users, pickups and configs shaped like the API's records
+'''
+class SyntheticData:
+    def __init__(self, seed=0, brands=50, models_per_brand=40):
+        self.random = random.Random(seed)
+        self.brands = [f"Brand{b}" for b in range(brands)]
+        self.models = {brand: [f"{brand}-M{m}" for m in range(models_per_brand)] for brand in self.brands}
+
+    def user(self):
+        return {
+            "firstName": self.random.choice(["Ada", "Grace", "Alan", "Edsger"]),
+            "lastName": self.random.choice(["Lovelace", "Hopper", "Turing", "Dijkstra"]),
+            "businessName": None,
+            "address": f"{self.random.randint(1, 9999)} Main St",
+            "customerType": self.random.choice(["Residential", "Business"]),
+            "email": f"user{self.random.randint(1, 10**9)}@example.com",
+        }
+
+    # a third of the batteries have a model in the config's MSRP table, the rest are priced per kWh
+    def battery(self, owner_id=1):
+        known = self.random.random() < 0.33
+        brand = self.random.choice(self.brands) if known else self.random.choice([None, "Unlisted"])
+        ev = self.random.random() < 0.5
+        battery = {
+            "chemistry": self.random.choice(CHEMISTRIES),
+            "batteryType": "EV" if ev else self.random.choice(BATTERY_TYPES),
+            "ownerId": owner_id,
+            "brand": None if ev else brand,
+            "model": None if ev or not known else self.random.choice(self.models[brand]),
+            "vehicleMake": brand if ev else None,
+            "vehicleModel": self.random.choice(self.models[brand]) if ev and known else None,
+            "weightLbs": self.random.randint(5, 1200),
+            "inputVoltage": self.random.choice([12, 48, 120, 240, 400]),
+            "outputVoltage": self.random.choice([12, 48, 120, 240, 400]),
+            "markedCapacitykWh": round(self.random.uniform(0.5, 120), 2),
+            "approxLengthUsedDays": self.random.randint(0, 4000),
+            "dateOriginallyPurchased": f"{self.random.randint(2012, 2025)}-{self.random.randint(1, 12):02d}-{self.random.randint(1, 28):02d}",
+            "isFunctioning": self.random.random() < 0.8,
+            "conditionOriginallyPurchased": self.random.choice(CONDITIONS),
+        }
+        if self.random.random() < 0.5:
+            battery["comments"] = "Synthetic battery"
+        return battery
+
+    def pickup(self, batteries, owner_id=1):
+        return {
+            "ownerId": owner_id,
+            "pickUpAddress": "1 Synthetic Way",
+            "batteries": [self.battery(owner_id) for _ in range(batteries)],
+            "addressType": self.random.choice(["Residential", "Business"]),
+            "requestedPickupDate": "2024-06-01",
+            "comments": None,
+        }
+
+    def config(self):
+        return {
+            "batteryModelMSRPs": {brand: {m: self.random.randint(500, 20000) for m in models} for brand, models in self.models.items()},
+            "batteryChemistryCostPerkWh": {c: round(self.random.uniform(40, 200), 1) for c in CHEMISTRIES},
+            "batteryPropsWeights": {k: self.random.randint(1, 5) for k in WEIGHTED_PROPS},
+        }
+
+# runs fn for at least min_time seconds (and min_runs times), timing every call
+def measure(fn, min_runs=5, min_time=0.5):
+    timings = []
+    started = time.perf_counter()
+    while len(timings) < min_runs or time.perf_counter() - started < min_time:
+        t0 = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - t0)
+    timings.sort()
+    def percentile(p):
+        return timings[min(len(timings) - 1, int(p / 100 * len(timings)))] * 1000
+    return {
+        "runs": len(timings),
+        "opsPerSec": len(timings) / sum(timings),
+        "meanMs": statistics.fmean(timings) * 1000,
+        "p50Ms": percentile(50),
+        "p90Ms": percentile(90),
+        "p99Ms": percentile(99),
+        "maxMs": timings[-1] * 1000,
+    }
+
+# bytes allocated by build() and still held by what it returns
+def measure_memory(build):
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        kept = build()
+        allocated = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    del kept
+    return allocated
+
+# stored size of pickups as decoded from request bodies, as dicts and as compact records
+def pickup_memory(data, pickups, batteries):
+    import records
+    bodies = [json.dumps({**data.pickup(batteries), "id": i, "createdAt": "2024-06-01T00:00:00", "updatedAt": "2024-06-01T00:00:00"})
+        for i in range(pickups)]
+    dicts = measure_memory(lambda: [json.loads(body) for body in bodies])
+    compact = measure_memory(lambda: [records.compact("pickups", json.loads(body)) for body in bodies])
+    count = pickups * batteries
+    return {"pickups": pickups, "dictBytesPerBattery": dicts / count, "compactBytesPerBattery": compact / count}
+
+def run(args):
+    import main
+    import batch_pricing
+    from quote_calculator import QuoteCalculator
+    from price_cache import PriceCache
+
+    data = SyntheticData(args.seed)
+    client = main.app.test_client()
+    config = data.config()
+    config_id = max(main.quote_configs.keys()) + 1
+    if client.post(f"/quoteConfig/{config_id}", json=config).status_code != 201:
+        sys.exit("could not create the benchmark QuoteConfig")
+    calculator = QuoteCalculator(config)
+    price_cache = PriceCache(main.app.config["PRICE_CACHE_SIZE"])
+    # ids well above the seed data, new ones for every POST
+    ids = itertools.count(10**6)
+    results = {}
+
+    for size in args.batteries:
+        pickup = data.pickup(size)
+        results[f"quote.scalar[{size}]"] = measure(lambda: calculator.final_quote_price(pickup))
+        results[f"quote.cached[{size}]"] = measure(lambda: price_cache.final_quote_price(calculator, pickup))
+        if batch_pricing.is_available():
+            results[f"quote.batch[{size}]"] = measure(lambda: batch_pricing.final_quote_price(calculator, pickup))
+        results[f"validate.batteries[{size}]"] = measure(lambda: main.battery_validation_errors(pickup["batteries"]))
+        results[f"POST /pickup[{size}]"] = measure(lambda: client.post(f"/pickup/{next(ids)}", json=pickup))
+
+    results["POST /user"] = measure(lambda: client.post(f"/user/{next(ids)}", json=data.user()))
+
+    large_pickup_id = next(ids)
+    client.post(f"/pickup/{large_pickup_id}", json=data.pickup(args.batteries[-1]))
+    for path in ["/user/1", "/pickup/1", f"/pickup/{large_pickup_id}", "/quote/1", "/agreement/1", f"/quoteConfig/{config_id}"]:
+        results[f"GET {path}"] = measure(lambda: client.get(path))
+    results["GET /quotes"] = measure(lambda: client.get("/quotes?limit=100"))
+    results["memory.pickups[100]"] = pickup_memory(data, 100, 100)
+
+    return {
+        "python": sys.version.split()[0],
+        "numpy": batch_pricing.is_available(),
+        "batteriesPerPickup": args.batteries,
+        "results": results,
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the quote hot path in-process")
+    parser.add_argument("--batteries", type=int, nargs="+", default=[1, 10, 100, 1000], help="Pickup sizes to benchmark")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic data")
+    parser.add_argument("--output", help="Write the JSON report to this file instead of stdout")
+    args = parser.parse_args()
+
+    report = json.dumps(run(args), indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
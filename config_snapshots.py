@@ -0,0 +1,83 @@
+import datetime
+import threading
+from types import MappingProxyType
+from quote_calculator import QuoteCalculator
+
+"""
+The active QuoteConfig. Each config is frozen into an immutable snapshot (the config and its
+compiled calculator) the first time it is used, and the active one is a single pointer record in
+the settings repository. Switching replaces the pointer, it never changes a snapshot, so a quote
+that already holds a snapshot is priced consistently while a switch happens, and the quote path
+reads the current snapshot without taking a lock.
+"""
+
+# id of the pointer record in the settings repository
+ACTIVE_QUOTE_CONFIG = 1
+
+def freeze(value):
+    if isinstance(value, dict):
+        return MappingProxyType({k: freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(v) for v in value)
+    return value
+
+'''
+ConfigSnapshot is a read-only copy of a QuoteConfig with the calculator compiled from it
+'''
+class ConfigSnapshot:
+    __slots__ = ("id", "config", "calculator")
+
+    def __init__(self, config):
+        self.id = config["id"]
+        self.config = freeze(config)
+        self.calculator = QuoteCalculator(self.config)
+
+    def __setattr__(self, name, value):
+        if hasattr(self, name):
+            raise AttributeError(f"ConfigSnapshot.{name} can't be changed")
+        object.__setattr__(self, name, value)
+
+'''
+ActiveConfig hands out the snapshot of the active config and switches it. With a repository
+shared between processes the pointer is re-read on every get(), since other processes can switch it
+'''
+class ActiveConfig:
+    def __init__(self, settings, quote_configs):
+        self.settings = settings
+        self.quote_configs = quote_configs
+        # configs never change once created, so snapshots are kept for good
+        self.snapshots = {}
+        self.switch_lock = threading.Lock()
+        pointer, version = settings.get_versioned(ACTIVE_QUOTE_CONFIG)
+        self.current = (version, self.snapshot(pointer["quoteConfigId"]))
+
+    def snapshot(self, config_id):
+        snapshot = self.snapshots.get(config_id)
+        if snapshot is None:
+            snapshot = self.snapshots.setdefault(config_id, ConfigSnapshot(self.quote_configs[config_id]))
+        return snapshot
+
+    def get(self):
+        current = self.current
+        if self.settings.shared:
+            pointer, version = self.settings.get_versioned(ACTIVE_QUOTE_CONFIG)
+            if version != current[0]:
+                current = self.current = (version, self.snapshot(pointer["quoteConfigId"]))
+        return current[1]
+
+    def pointer(self):
+        return self.settings[ACTIVE_QUOTE_CONFIG]
+
+    # makes config_id the active config, returns the previous and the new snapshot
+    def activate(self, config_id):
+        snapshot = self.snapshot(config_id)
+        with self.switch_lock:
+            previous = self.get()
+            self.settings[ACTIVE_QUOTE_CONFIG] = {
+                "id": ACTIVE_QUOTE_CONFIG,
+                "quoteConfigId": config_id,
+                "updatedAt": datetime.datetime.now().isoformat(),
+            }
+            _, version = self.settings.get_versioned(ACTIVE_QUOTE_CONFIG)
+            self.current = (version, snapshot)
+        return previous, snapshot
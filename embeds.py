@@ -0,0 +1,70 @@
+from collections.abc import Mapping
+
+"""
+Expansion of related records and sparse fieldsets for reads. ?expand= names relations to embed,
+dotted for nested ones (expand=associatedQuote.associatedPickup.owner), and ?fields= the fields
+to return, dotted for fields of embedded records (fields=id,associatedQuote.quotePrice).
+Related records are fetched with one multi-get per relation for a whole page of records, and new
+dicts are built for the response so stored records are never modified.
+"""
+
+# relation name -> (id field, repository name) for every repository that has relations
+RELATIONS = {
+    "agreements": {"associatedQuote": ("associatedQuoteId", "quotes")},
+    "quotes": {"associatedPickup": ("associatedPickupId", "pickups"), "seller": ("sellerId", "users"), "quoteConfig": ("quoteConfigId", "quote_configs")},
+    "pickups": {"owner": ("ownerId", "users")},
+}
+
+# records their own resource answers 404 for, embedded as None
+HIDDEN = {
+    "users": lambda user: not user["isActive"],
+}
+
+def paths(value):
+    return [p.strip().split(".") for p in value.split(",") if p.strip()]
+
+# "associatedQuote.seller,associatedQuote.associatedPickup" -> {"associatedQuote": {"seller": {}, "associatedPickup": {}}}
+def parse_expand(value, name):
+    tree = {}
+    for path in paths(value):
+        node, current = tree, name
+        for relation in path:
+            if relation not in RELATIONS.get(current, {}):
+                raise ValueError(f"{relation} is not a relation of {current}")
+            node = node.setdefault(relation, {})
+            current = RELATIONS[current][relation][1]
+    return tree
+
+def parse_fields(value):
+    tree = {}
+    for path in paths(value):
+        node = tree
+        for field in path:
+            node = node.setdefault(field, {})
+    return tree
+
+# returns copies of records with the relations in tree embedded (None when the related record
+# doesn't exist or is hidden), and appends (record, version) of every related record to embedded,
+# hidden ones included so the response changes when they do
+def expand(records, name, tree, repositories, embedded):
+    if not tree:
+        return records
+    records = [dict(r) for r in records]
+    for relation, subtree in tree.items():
+        field, target = RELATIONS[name][relation]
+        hidden = HIDDEN.get(target)
+        ids = {r[field] for r in records if r.get(field) is not None}
+        related = {}
+        for id, (record, version) in sorted(repositories[target].get_many_versioned(ids).items()):
+            embedded.append((record, version))
+            if hidden is None or not hidden(record):
+                related[id] = record
+        related = dict(zip(related, expand(list(related.values()), target, subtree, repositories, embedded)))
+        for r in records:
+            r[relation] = related.get(r.get(field))
+    return records
+
+def select_fields(record, tree):
+    if not tree or not isinstance(record, Mapping):
+        return record
+    return {k: select_fields(record[k], subtree) for k, subtree in tree.items() if k in record}
@@ -0,0 +1,120 @@
+import datetime
+import heapq
+import os
+import threading
+from quote_dates import parse_timestamp
+
+"""
+Quote expiry. Open quotes are kept in a min-heap on their expiry date, and one thread sleeps
+until the earliest of them is due, then marks every due quote as expired. Scheduling and expiring
+a quote are O(log n) and nothing ever scans the quotes table, except to fill the heap once on
+start.
+
+Whether a quote can still be agreed to doesn't depend on the thread having run: is_expired only
+compares the quote's own expiry date with the clock, so it holds for quotes issued by other
+processes sharing the repository too.
+"""
+
+def is_expired(quote, now=None):
+    if quote.get("isExpired"):
+        return True
+    expiry = quote.get("quoteExpiryDate")
+    return expiry is not None and parse_timestamp(expiry).replace(tzinfo=None) <= (now or datetime.datetime.now())
+
+'''
+QuoteExpirer marks quotes as expired once their expiry date passes. Approved quotes are never
+expired, and listeners are called with the id of every quote it expires
+'''
+class QuoteExpirer:
+    def __init__(self, quotes):
+        self.quotes = quotes
+        self.lock = threading.Lock()
+        self.due = threading.Condition(self.lock)
+        # (expiry date, quote id)
+        self.heap = []
+        self.listeners = []
+        self.thread = None
+        self.thread_pid = None
+        # process that stopped the expirer for good, see stop()
+        self.stopped_pid = None
+
+    # fills the heap with the quotes on record that are still open, the thread isn't started
+    def load(self):
+        entries = [(parse_timestamp(q["quoteExpiryDate"]).replace(tzinfo=None), q["id"]) for q in self.quotes.scan()
+            if not q["isApproved"] and not q.get("isExpired") and q.get("quoteExpiryDate")]
+        heapq.heapify(entries)
+        with self.lock:
+            self.heap = entries
+            self.due.notify()
+
+    def schedule(self, quote):
+        entry = (parse_timestamp(quote["quoteExpiryDate"]).replace(tzinfo=None), quote["id"])
+        with self.lock:
+            self.start()
+            heapq.heappush(self.heap, entry)
+            # the thread only needs waking when this is the new earliest expiry
+            if self.heap[0] is entry:
+                self.due.notify()
+
+    # a forked worker gets its own thread (and lock, the parent's thread may have held it)
+    def after_fork(self):
+        self.lock = threading.Lock()
+        self.due = threading.Condition(self.lock)
+        with self.lock:
+            self.start()
+
+    # started by the first request or quote of a serving process (ensure_started, schedule) and in
+    # forked workers, never at import, so a process that only imports the app expires nothing
+    def ensure_started(self):
+        if self.thread_pid == os.getpid():
+            return
+        with self.lock:
+            self.start()
+
+    def start(self):
+        if self.stopped_pid == os.getpid() or (self.thread is not None and self.thread_pid == os.getpid()):
+            return
+        self.thread_pid = os.getpid()
+        self.thread = threading.Thread(target=self.run, name="quote-expirer", daemon=True)
+        self.thread.start()
+
+    # called by a process that forks workers and serves nothing itself, so its stale copy of the
+    # quotes is never expired. Workers forked from it start their own thread
+    def stop(self):
+        with self.lock:
+            self.stopped_pid = os.getpid()
+            self.due.notify()
+
+    def run(self):
+        while True:
+            with self.lock:
+                while True:
+                    if self.stopped_pid == os.getpid():
+                        return
+                    now = datetime.datetime.now()
+                    if self.heap and self.heap[0][0] <= now:
+                        break
+                    self.due.wait(None if not self.heap else (self.heap[0][0] - now).total_seconds())
+                due = []
+                while self.heap and self.heap[0][0] <= now:
+                    due.append(heapq.heappop(self.heap)[1])
+            for quote_id in due:
+                self.expire(quote_id, now)
+
+    def expire(self, quote_id, now):
+        try:
+            quote = self.quotes[quote_id]
+        except KeyError:
+            return
+        if not self.expirable(quote, now):
+            return
+        # checked again in the same step as the write, an agreement may have come in meanwhile
+        if self.quotes.update(quote_id, {"isExpired": True, "updatedAt": now.isoformat()},
+                lambda current: self.expirable(current, now)) is None:
+            return
+        for listener in self.listeners:
+            listener(quote_id)
+
+    # not approved in the meantime nor already expired, and due
+    def expirable(self, quote, now):
+        return not quote["isApproved"] and not quote.get("isExpired") and is_expired(quote, now)
@@ -0,0 +1,53 @@
+from collections.abc import Mapping
+from flask.json.provider import DefaultJSONProvider
+import json
+
+# orjson is optional, without it the stdlib json module is used
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+"""
+JSON encoding and decoding for the API, on orjson when it is installed. Output means the same
+JSON either way: non-string keys become strings like the stdlib does, and values orjson can't
+handle (integers over 64 bits, NaN literals in request bodies) fall back to the stdlib.
+Read-only mappings such as the compact records of records.py are encoded as objects.
+"""
+
+ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS if orjson else 0
+
+def default(value):
+    if isinstance(value, Mapping):
+        return dict(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+# pretty output is indented, compact output drops the spaces the stdlib adds after separators
+def dumps(data, pretty=False, compact=False):
+    if orjson is not None:
+        try:
+            return orjson.dumps(data, default=default, option=ORJSON_OPTIONS | (orjson.OPT_INDENT_2 if pretty and not compact else 0))
+        except TypeError:
+            pass
+    if compact:
+        return json.dumps(data, separators=(",", ":"), default=default).encode()
+    return json.dumps(data, indent=4 if pretty else None, default=default).encode()
+
+def loads(data):
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(data)
+
+'''
+FastJSONProvider decodes request bodies (request.json, reqparse) and encodes jsonify output
+with the functions above
+'''
+class FastJSONProvider(DefaultJSONProvider):
+    def loads(self, s, **kwargs):
+        return loads(s)
+
+    def dumps(self, obj, **kwargs):
+        return dumps(obj, compact=self._app.config["JSON_COMPACT"]).decode()
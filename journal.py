@@ -0,0 +1,228 @@
+import mmap
+import os
+import threading
+import fast_json
+
+"""
+Durability for the memory backend. Every write to a repository is appended to a journal as the
+full new record (or null once it is deleted), so replaying entries in order is idempotent. One
+writer thread writes and fsyncs everything appended since its last write at once (group commit),
+and request threads can wait for their own entries to be on disk before responding.
+
+Every snapshot_entries entries the journal moves to a new segment file and a snapshot of all
+repositories is written in the background. A restart loads the latest snapshot through mmap and
+replays only the segments written since, then journals into a fresh segment.
+
+    <directory>/snapshot.jsonl         {"journalSegment": n} then ["name", id, record] lines
+    <directory>/journal-<n>.jsonl      [seq, "name", id, record] lines
+"""
+
+SNAPSHOT_FILE = "snapshot.jsonl"
+
+def segment_name(segment):
+    return f"journal-{segment:06d}.jsonl"
+
+def fsync_directory(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+'''
+Journal persists the writes of a set of repositories. Call restore() before anything else uses
+them, then add append() to their listeners
+'''
+class Journal:
+    def __init__(self, directory, repositories, snapshot_entries=100000):
+        self.directory = directory
+        self.repositories = repositories
+        self.snapshot_entries = snapshot_entries
+        self.lock = threading.Lock()
+        self.pending = threading.Condition(self.lock)
+        self.flushed = threading.Condition(self.lock)
+        # taken around taking the buffer and writing it, so batches reach the file in order
+        self.write_lock = threading.Lock()
+        self.buffer = []
+        self.seq = 0
+        self.flushed_seq = 0
+        self.local = threading.local()
+        self.entries_since_snapshot = 0
+        self.snapshotting = False
+        self.segment = 0
+        self.file = None
+        self.writer = None
+        self.writer_pid = None
+        # process that closed the journal, it can't append anything afterwards
+        self.closed_pid = None
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def segments(self):
+        return sorted(int(f[8:-6]) for f in os.listdir(self.directory) if f.startswith("journal-") and f.endswith(".jsonl"))
+
+    # loads the snapshot and replays the journal into the repositories, returns whether there was
+    # anything on disk (if not, the repositories keep their seed records)
+    def restore(self):
+        first_segment = 0
+        snapshot_path = self.path(SNAPSHOT_FILE)
+        # until the first snapshot is written the journal holds changes to the seed records
+        records = {name: {r["id"]: r for r in repository.scan()} for name, repository in self.repositories.items()}
+        if os.path.exists(snapshot_path):
+            records = {}
+            with open(snapshot_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as snapshot:
+                first_segment = fast_json.loads(snapshot.readline())["journalSegment"]
+                for line in iter(snapshot.readline, b""):
+                    name, id, record = fast_json.loads(line)
+                    records.setdefault(name, {})[id] = record
+
+        segments = [s for s in self.segments() if s >= first_segment]
+        for segment in segments:
+            self.replay(segment, records)
+
+        self.segment = max(segments, default=first_segment)
+        if not os.path.exists(snapshot_path) and not segments:
+            return False
+        for name, repository in self.repositories.items():
+            repository.reset(records.get(name, {}))
+        return True
+
+    def replay(self, segment, records):
+        with open(self.path(segment_name(segment)), "rb") as f:
+            for line in f:
+                try:
+                    seq, name, id, record = fast_json.loads(line)
+                except ValueError:
+                    # the last write before a crash can be cut short, it was never acknowledged
+                    break
+                self.seq = max(self.seq, seq)
+                if record is None:
+                    records.setdefault(name, {}).pop(id, None)
+                else:
+                    records.setdefault(name, {})[id] = record
+        self.flushed_seq = self.seq
+
+    # repository listener, called right after the record changed
+    def append(self, name, id):
+        record = self.repositories[name].get(id)
+        payload = fast_json.dumps(record)
+        with self.lock:
+            self.start_writer()
+            self.seq += 1
+            self.buffer.append(b'[%d,"%s",%d,%s]\n' % (self.seq, name.encode(), id, payload))
+            self.local.seq = self.seq
+            self.pending.notify()
+
+    # blocks until everything this thread appended is on disk
+    def wait(self):
+        seq = getattr(self.local, "seq", 0)
+        if seq <= self.flushed_seq:
+            return
+        with self.lock:
+            while self.flushed_seq < seq:
+                self.flushed.wait()
+
+    # started by the first append of a process, into a segment of its own
+    def start_writer(self):
+        if self.closed_pid == os.getpid():
+            raise RuntimeError("The journal was closed in this process")
+        if self.writer is not None and self.writer_pid == os.getpid():
+            return
+        self.writer_pid = os.getpid()
+        self.open_next_segment()
+        self.writer = threading.Thread(target=self.run, name="journal-writer", daemon=True)
+        self.writer.start()
+
+    # segment numbers are taken by creating the file exclusively, so processes holding the same
+    # journal (like a parent and the workers it forked) never append to the same segment
+    def open_next_segment(self):
+        while True:
+            self.segment += 1
+            try:
+                fd = os.open(self.path(segment_name(self.segment)), os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_APPEND, 0o644)
+            except FileExistsError:
+                continue
+            self.file = os.fdopen(fd, "ab")
+            return
+
+    # a forked worker drops the parent's buffer, locks (the parent's threads may have held them)
+    # and segment file, its first append starts a writer and segment of its own
+    def after_fork(self):
+        self.lock = threading.Lock()
+        self.pending = threading.Condition(self.lock)
+        self.flushed = threading.Condition(self.lock)
+        self.write_lock = threading.Lock()
+        self.buffer = []
+        self.flushed_seq = self.seq
+        self.local = threading.local()
+        self.entries_since_snapshot = 0
+        self.snapshotting = False
+        self.file = None
+        self.writer = None
+
+    def run(self):
+        while True:
+            with self.lock:
+                while not self.buffer:
+                    self.pending.wait()
+            with self.write_lock:
+                with self.lock:
+                    buffer, self.buffer = self.buffer, []
+                    seq = self.seq
+                self.write(buffer)
+            with self.lock:
+                self.flushed_seq = seq
+                self.flushed.notify_all()
+                self.entries_since_snapshot += len(buffer)
+                if self.entries_since_snapshot < self.snapshot_entries or self.snapshotting:
+                    continue
+                self.entries_since_snapshot = 0
+                self.snapshotting = True
+            # entries appended from now on go to a new segment, the snapshot covers the others
+            with self.write_lock:
+                self.file.close()
+                self.open_next_segment()
+                fsync_directory(self.directory)
+                segment = self.segment
+            threading.Thread(target=self.write_snapshot, args=(segment,), name="journal-snapshot", daemon=True).start()
+
+    # Records can change while they are written out, the segments replayed on top of the
+    # snapshot hold their newer versions
+    def write_snapshot(self, segment):
+        try:
+            temporary = self.path(SNAPSHOT_FILE + ".tmp")
+            with open(temporary, "wb") as f:
+                f.write(fast_json.dumps({"journalSegment": segment}) + b"\n")
+                for name, repository in self.repositories.items():
+                    for record in repository.scan():
+                        f.write(b'["%s",%d,%s]\n' % (name.encode(), record["id"], fast_json.dumps(record)))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temporary, self.path(SNAPSHOT_FILE))
+            fsync_directory(self.directory)
+            for old in self.segments():
+                if old < segment:
+                    os.remove(self.path(segment_name(old)))
+        finally:
+            with self.lock:
+                self.snapshotting = False
+
+    def write(self, buffer):
+        self.file.write(b"".join(buffer))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    # writes out whatever is still buffered and closes the segment, at exit and in a parent before
+    # it forks workers. The process can't append anything afterwards
+    def close(self):
+        with self.write_lock:
+            with self.lock:
+                self.closed_pid = os.getpid()
+                if self.file is None or self.file.closed or self.writer_pid != os.getpid():
+                    return
+                buffer, self.buffer = self.buffer, []
+            if buffer:
+                self.write(buffer)
+            self.file.close()
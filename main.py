@@ -1,12 +1,94 @@
-from flask import Flask, jsonify
-from flask_restful import Api, Resource, reqparse, abort
+from concurrent.futures import ThreadPoolExecutor
+import atexit
+from flask import Flask, jsonify, request, Response, stream_with_context, make_response, g
+from flask_restful import Api, Resource, reqparse, abort, inputs
 import datetime
-from jsonschema import validate, ValidationError
-from quote_calculator import QuoteCalculator
+import hashlib
+import time
+import fast_json
+from fast_json import FastJSONProvider
+from jsonschema.validators import validator_for
+from config_snapshots import ActiveConfig, ConfigSnapshot
+from quote_dates import parse_date, parse_timestamp
+import batch_pricing
+from requote import Requoter
+from repositories import create_repositories
+from journal import Journal
+from response_cache import ResponseCache
+from price_cache import PriceCache
+from metrics import Metrics
+import embeds
+from profiling import RequestProfiler
+from analytics import DIMENSIONS, QuoteAnalytics
+from expiry import QuoteExpirer, is_expired
 
 app = Flask(__name__)
 api = Api(app)
 
+# Settings, any of them can be overridden with a BATTERIA_ prefixed environment variable
+app.config.from_mapping(
+    # pickups with at least this many batteries are priced by the vectorized batch engine
+    BATCH_PRICING_THRESHOLD=256,
+    # "memory" keeps records in process, "sqlite" persists them and shares them between workers
+    REPOSITORY_BACKEND="memory",
+    SQLITE_DATABASE="batteria.db",
+    # store memory backend records as the compact slot objects of records.py instead of dicts
+    COMPACT_RECORDS=True,
+    # set to a directory to journal every write of the memory backend there and restore it on start.
+    # With JOURNAL_SYNC writes are only acknowledged once journaled to disk
+    JOURNAL_DIRECTORY=None,
+    JOURNAL_SYNC=True,
+    JOURNAL_SNAPSHOT_ENTRIES=100000,
+    # with JOURNAL_SYNC bulk pickup results are sent this many lines at a time, after one wait for the journal
+    BULK_ACK_LINES=500,
+    # largest page the list endpoints return
+    MAX_PAGE_SIZE=500,
+    # most ids a batch read (?ids= or :batchGet) can ask for
+    MAX_BATCH_SIZE=1000,
+    # largest batteries x configs price matrix a pricing simulation can ask for
+    MAX_SIMULATION_PRICES=1000000,
+    # when set, open quotes affected by a new QuoteConfig are re-priced in the background
+    REQUOTE_ON_NEW_CONFIG=False,
+    REQUOTE_WORKERS=2,
+    # when set, pickup POSTs return right away and quotes are computed by QUOTE_WORKERS threads
+    ASYNC_QUOTES=False,
+    QUOTE_WORKERS=4,
+    # number of encoded GET responses kept for records that haven't changed, 0 disables the cache
+    RESPONSE_CACHE_SIZE=4096,
+    # number of battery prices memoized for pickups priced one battery at a time, 0 disables the cache
+    PRICE_CACHE_SIZE=65536,
+    # quotes can be agreed to for this many days after they are issued
+    QUOTE_LIFETIME_DAYS=30,
+    # with the sqlite backend quote analytics are rebuilt at most this often, to include other workers' quotes
+    ANALYTICS_REFRESH_SECONDS=60,
+    # drop all optional whitespace from JSON responses, even in debug mode
+    JSON_COMPACT=False,
+    # record request, stage and pricing metrics and serve them on /metrics
+    METRICS_ENABLED=False,
+    # profile PROFILE_RATE of the requests to PROFILE_RESOURCES, results are served on /admin/profile.
+    # "cprofile" mode reports pstats, "sample" mode collapsed stacks sampled every PROFILE_SAMPLE_INTERVAL seconds
+    PROFILE_ENABLED=False,
+    PROFILE_MODE="cprofile",
+    PROFILE_RATE=0.01,
+    PROFILE_RESOURCES=["Pickup", "QuoteConfig"],
+    PROFILE_SAMPLE_INTERVAL=0.005,
+)
+app.config.from_prefixed_env("BATTERIA")
+app.json = FastJSONProvider(app)
+
+metrics = Metrics(app.config["METRICS_ENABLED"])
+metrics.describe("http_request_duration_seconds", "Request latency per endpoint, method and status")
+metrics.describe("stage_duration_seconds", "Time spent in each stage of pickup creation and quoting")
+metrics.describe("batteries_priced_total", "Batteries priced, by base price source (MSRP table or chemistry cost per kWh)")
+metrics.describe("validation_failures_total", "Documents rejected by schema validation, per schema")
+
+# same output as flask_restful's default representation, encoded by fast_json
+@api.representation("application/json")
+def output_json(data, code, headers=None):
+    response = make_response(fast_json.dumps(data, pretty=app.debug, compact=app.config["JSON_COMPACT"]) + b"\n", code)
+    response.headers.extend(headers or {})
+    return response
+
 # Validation
 users_create_args = reqparse.RequestParser()
 users_create_args.add_argument("firstName", type=str, required=True, help="First name of User")
@@ -24,6 +106,9 @@ pickups_create_args.add_argument("addressType", type=str, required=True, choices
 pickups_create_args.add_argument("requestedPickupDate", type=str, required=True, help="Date requested by user for pickup")
 pickups_create_args.add_argument("comments", type=str, required=False, help="Optional additional comments")
 
+pickups_options_args = reqparse.RequestParser()
+pickups_options_args.add_argument("async", type=inputs.boolean, location="args", help="Quote the pickup in the background and return a quote job id")
+
 batterySchema = {
     "type": "object",
     "properties": {
@@ -63,6 +148,59 @@ batterySchema = {
     "additionalProperties": False
 }
 
+# reads can embed related records and return only some of the fields, see embeds.py
+read_args = reqparse.RequestParser()
+read_args.add_argument("expand", type=str, location="args", help="Related records to embed, comma separated, e.g. associatedQuote.associatedPickup.owner")
+read_args.add_argument("fields", type=str, location="args", help="Fields to return, comma separated, e.g. id,associatedQuote.quotePrice")
+
+# list endpoints page by id: pass the previous page's nextCursor as after
+list_args = read_args.copy()
+list_args.add_argument("after", type=int, location="args", default=-1, help="Only records with a greater id (cursor)")
+list_args.add_argument("limit", type=inputs.positive, location="args", default=50, help="Maximum number of records returned")
+list_args.add_argument("since", type=str, location="args", help="Only records created at or after this date")
+list_args.add_argument("until", type=str, location="args", help="Only records created before this date")
+list_args.add_argument("ids", type=str, location="args", help="Read these records instead of a page, comma separated ids")
+
+users_list_args = list_args.copy()
+users_list_args.add_argument("isActive", type=inputs.boolean, location="args", default=True, help="Only active or deactivated users")
+
+pickups_list_args = list_args.copy()
+pickups_list_args.add_argument("ownerId", type=int, location="args", help="Only pickups of this owner")
+
+quotes_list_args = list_args.copy()
+quotes_list_args.add_argument("sellerId", type=int, location="args", help="Only quotes for this seller")
+quotes_list_args.add_argument("associatedPickupId", type=int, location="args", help="Only quotes for this pickup")
+quotes_list_args.add_argument("isApproved", type=inputs.boolean, location="args", help="Only approved or unapproved quotes")
+quotes_list_args.add_argument("isExpired", type=inputs.boolean, location="args", help="Only expired or unexpired quotes")
+
+agreements_list_args = list_args.copy()
+agreements_list_args.add_argument("associatedQuoteId", type=int, location="args", help="Only agreements for this quote")
+
+batch_get_args = reqparse.RequestParser()
+batch_get_args.add_argument("ids", type=list, location="json", required=True, help="Ids of the records to read")
+
+# bulk pickups arrive one JSON document per line, so reqparse can't be used and the
+# pickup arguments above are mirrored here. Batteries are checked by battery_validation_errors
+pickupSchema = {
+    "type": "object",
+    "properties": {
+        "id": {"type": "integer"},
+        "ownerId": {"type": "integer"},
+        "pickUpAddress": {"type": "string"},
+        "batteries": {"type": "array"},
+        "addressType": {"enum" : ["Residential", "Business"]},
+        "requestedPickupDate": {"type": "string"},
+        "comments": {"type": ["string", "null"]},
+    },
+    "required": ["id",
+        "ownerId",
+        "pickUpAddress",
+        "batteries",
+        "addressType",
+        "requestedPickupDate"
+        ]
+}
+
 agreements_create_args = reqparse.RequestParser()
 agreements_create_args.add_argument("associatedQuoteId", type=int, required=True, help="Id of Quote associated with this agreement")
 agreements_create_args.add_argument("agreedDate", type=str, required=True, help="Date user agreed to this quote")
@@ -74,6 +212,30 @@ quote_config_create_args.add_argument("batteryModelMSRPs", type=dict, required=T
 quote_config_create_args.add_argument("batteryChemistryCostPerkWh", type=dict, required=True, help="Costs per kilowatt-hour for given battery chemistries")
 quote_config_create_args.add_argument("batteryPropsWeights", type=dict, required=True, help="Weighting for calculating quality score of a battery")
 
+profile_report_args = reqparse.RequestParser()
+profile_report_args.add_argument("resource", type=str, location="args", help="Resource to report on, e.g. Pickup")
+profile_report_args.add_argument("format", type=str, location="args", default="text", choices=("text", "pstats", "collapsed"), help="Printed pstats report, binary pstats file, or collapsed stacks")
+profile_report_args.add_argument("sort", type=str, location="args", default="cumulative", choices=("cumulative", "tottime", "calls", "ncalls"), help="pstats sort key")
+profile_report_args.add_argument("limit", type=inputs.positive, location="args", default=50, help="Number of functions in the printed report")
+
+quote_config_options_args = reqparse.RequestParser()
+quote_config_options_args.add_argument("requote", type=inputs.boolean, location="args", help="Re-price open quotes affected by this config")
+quote_config_options_args.add_argument("activate", type=inputs.boolean, location="args", default=True, help="Make this config the active one (false stages it)")
+
+active_quote_config_args = reqparse.RequestParser()
+active_quote_config_args.add_argument("quoteConfigId", type=int, required=True, help="Id of the QuoteConfig new quotes are priced with")
+
+pricing_simulation_args = reqparse.RequestParser()
+pricing_simulation_args.add_argument("pickupIds", type=list, location="json", default=[], help="Ids of pickups whose batteries are priced")
+pricing_simulation_args.add_argument("batteries", type=list, location="json", default=[], help="More batteries to price, inline")
+pricing_simulation_args.add_argument("quoteConfigIds", type=list, location="json", default=[], help="Ids of QuoteConfigs to price with")
+pricing_simulation_args.add_argument("quoteConfigs", type=list, location="json", default=[], help="More QuoteConfigs to price with, inline")
+
+quote_analytics_args = reqparse.RequestParser()
+quote_analytics_args.add_argument("groupBy", type=str, location="args", default="", help="Dimensions to group by, comma separated: chemistry, batteryType, brand, week")
+quote_analytics_args.add_argument("since", type=str, location="args", help="Only quotes issued in the week of this date or later")
+quote_analytics_args.add_argument("until", type=str, location="args", help="Only quotes issued in weeks starting before this date")
+
 batteryPropsWeightsSchema = {
     "type": "object",
     "properties": {
@@ -102,9 +264,42 @@ batteryPropsWeightsSchema = {
     "additionalProperties": False
 }
 
-# Repositories (in lieu of Databases)
+quoteConfigSchema = {
+    "type": "object",
+    "properties": {
+        "batteryModelMSRPs": {"type": "object", "additionalProperties": {"type": "object", "additionalProperties": {"type": "number"}}},
+        "batteryChemistryCostPerkWh": {"type": "object", "additionalProperties": {"type": "number"}},
+        "batteryPropsWeights": batteryPropsWeightsSchema
+    },
+    "required": ["batteryModelMSRPs", "batteryChemistryCostPerkWh", "batteryPropsWeights"]
+}
+
+# schemas are checked and compiled into validators once, at import
+def compile_schema(schema):
+    validator_class = validator_for(schema)
+    validator_class.check_schema(schema)
+    return validator_class(schema)
+
+battery_validator = compile_schema(batterySchema)
+batteries_validator = compile_schema({"type": "array", "items": batterySchema})
+pickup_validator = compile_schema(pickupSchema)
+quote_config_validator = compile_schema(quoteConfigSchema)
+
+def validation_messages(validator, instance):
+    return [f"{'.'.join(str(p) for p in e.path) or 'root'}: {e.message}" for e in validator.iter_errors(instance)]
 
-users = {
+# all batteries are checked in one pass for the common all-valid case, errors are
+# only collected (keyed by battery index) when that fails
+def battery_validation_errors(batteries):
+    if batteries_validator.is_valid(batteries):
+        return {}
+    errors = {i: validation_messages(battery_validator, b) for i, b in enumerate(batteries) if not battery_validator.is_valid(b)}
+    metrics.inc("validation_failures_total", len(errors), schema="battery")
+    return errors
+
+# Repositories (in lieu of Databases), seeded with these sample records when empty
+
+seed_users = {
     1: {
             "id": 1,
             "firstName": "John",
@@ -119,7 +314,7 @@ users = {
     }
 }
 
-pickups = {
+seed_pickups = {
     1: {
         "id": 1,
         "ownerId": 1,
@@ -149,7 +344,7 @@ pickups = {
         "comments": "Moving out of town and no longer need this"
     }
 }
-quotes = {
+seed_quotes = {
     1: {
         "id": 1,
         "quotePrice": 10000,
@@ -157,11 +352,13 @@ quotes = {
         "quoteExpiryDate": "2021-02-01 23:26:08.712542",
         "sellerId": 1,
         "associatedPickupId": 1,
-        "isApproved": True
+        "quoteConfigId": 1,
+        "isApproved": True,
+        "isExpired": False
     }
 }
 
-agreements = {
+seed_agreements = {
     1: {
         "id": 1,
         "associatedQuoteId": 1,
@@ -173,7 +370,7 @@ agreements = {
     }
 }
 
-quote_configs = {
+seed_quote_configs = {
     1: {
         "id": 1,
         "batteryModelMSRPs": {
@@ -203,6 +400,68 @@ quote_configs = {
     }
 }
 
+seed_settings = {
+    1: {
+        "id": 1,
+        "quoteConfigId": 1,
+        "updatedAt": "2021-01-01 23:26:08.712542"
+    }
+}
+
+repositories = create_repositories(app.config["REPOSITORY_BACKEND"], {
+    "users": seed_users,
+    "pickups": seed_pickups,
+    "quotes": seed_quotes,
+    "agreements": seed_agreements,
+    "quote_configs": seed_quote_configs,
+    "jobs": {},
+    "settings": seed_settings,
+    "quote_contributions": {},
+}, app.config["SQLITE_DATABASE"], app.config["COMPACT_RECORDS"])
+
+journal = None
+if app.config["JOURNAL_DIRECTORY"]:
+    if app.config["REPOSITORY_BACKEND"] != "memory":
+        raise ValueError("JOURNAL_DIRECTORY only applies to the memory backend")
+    journal = Journal(app.config["JOURNAL_DIRECTORY"], repositories, app.config["JOURNAL_SNAPSHOT_ENTRIES"])
+    journal.restore()
+    for repository in repositories.values():
+        repository.listeners.append(journal.append)
+    atexit.register(journal.close)
+
+users = repositories["users"]
+pickups = repositories["pickups"]
+quotes = repositories["quotes"]
+agreements = repositories["agreements"]
+quote_configs = repositories["quote_configs"]
+jobs = repositories["jobs"]
+settings = repositories["settings"]
+quote_contributions = repositories["quote_contributions"]
+
+response_cache = ResponseCache(app.config["RESPONSE_CACHE_SIZE"])
+for repository in repositories.values():
+    repository.listeners.append(response_cache.invalidate)
+
+price_cache = PriceCache(app.config["PRICE_CACHE_SIZE"])
+
+# serve.py calls this in the parent before it forks workers. The parent serves nothing, so it must
+# not run background work or write anything from its own, soon stale, copy of the records
+def before_fork():
+    expirer.stop()
+    if journal is not None:
+        journal.close()
+
+# serve.py calls this in every worker process forked after the app was imported
+def after_fork():
+    for repository in repositories.values():
+        repository.after_fork()
+    expirer.after_fork()
+    if journal is not None:
+        journal.after_fork()
+
+# snapshot of the QuoteConfig new quotes are priced with, see config_snapshots.py
+active_config = ActiveConfig(settings, quote_configs)
+
 # helper functions
 
 def abort_if_entity_not_found(id, repository, entity_name):
@@ -213,21 +472,257 @@ def abort_if_entity_exists(id, repository, entity_name):
     if id in repository:
         abort(409, message=f"{entity_name} with that id already exists")
 
+# the existence checks above are only a shortcut, add() decides atomically who gets the id
+def add_entity_or_abort(id, record, repository, entity_name):
+    if not repository.add(id, record):
+        abort(409, message=f"{entity_name} with that id already exists")
+
+def get_versioned_or_abort(id, repository, entity_name):
+    try:
+        return repository.get_versioned(id)
+    except KeyError:
+        abort(404, message=f"{entity_name} id not found")
+
+def last_modified(record):
+    date = record.get("updatedAt") or record.get("createdAt") or record.get("quoteIssuedDate")
+    try:
+        # naive dates are the server's local time
+        return parse_timestamp(date).astimezone(datetime.timezone.utc) if date else None
+    except (ValueError, OverflowError):
+        return None
+
+# GET response for a stored record, encoded at most once per record version. The ETag is the
+# version, so clients revalidating with If-None-Match (or If-Modified-Since) get a 304 until it changes
+# Other representations of the same record (variant) are cached next to it, and their ETags end in
+# a hash of the variant so no two representations share one. The hash is stable across processes.
+# Versions that don't survive a restart come with the repository's epoch, which the ETag starts with
+def record_response(key, version, modified, build, variant=(), epoch=None):
+    etag = "-".join(str(v) for v in ((epoch,) if epoch else ()) + (*key, *version))
+    if variant:
+        etag += "-" + hashlib.blake2b(repr(variant).encode(), digest_size=4).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        body = response_cache.get(key + variant, version)
+        if body is None:
+            body = api.make_response(build(), 200).get_data()
+            response_cache.put(key + variant, version, body)
+        response = Response(body, mimetype="application/json")
+    response.set_etag(etag)
+    if modified:
+        response.last_modified = modified
+    return response.make_conditional(request)
+
+# parsed ?expand= and ?fields= of a read, default_expand applies when expand isn't given
+def read_options(repository, args, default_expand=""):
+    expand = args["expand"] if args["expand"] is not None else default_expand
+    try:
+        return embeds.parse_expand(expand, repository.name), embeds.parse_fields(args["fields"] or "")
+    except ValueError as e:
+        abort(400, message=str(e))
+
+# records as returned by reads: related records embedded and fields selected
+def shape_records(repository, records, options, embedded):
+    expand, fields = options
+    records = embeds.expand(records, repository.name, expand, repositories, embedded)
+    return [embeds.select_fields(r, fields) for r in records]
+
+# GET of one record. Its response is current while the record and every embedded record are unchanged
+# reject(record) can return a response to send instead
+def read_record(repository, id, entity_name, default_expand="", reject=None):
+    record, version = get_versioned_or_abort(id, repository, entity_name)
+    rejection = reject(record) if reject is not None else None
+    if rejection is not None:
+        return rejection
+    args = read_args.parse_args()
+    options = read_options(repository, args, default_expand)
+    embedded = []
+    shaped = shape_records(repository, [record], options, embedded)[0]
+    modified = max(filter(None, [last_modified(record)] + [last_modified(r) for r, _ in embedded]), default=None)
+    variant = () if args["expand"] is None and args["fields"] is None else (args["expand"], args["fields"])
+    return record_response((repository.name, id), (version, *(v for _, v in embedded)), modified, lambda: shaped, variant, repository.epoch)
+
+def parse_date_arg(value, name):
+    if value is None:
+        return None
+    try:
+        # aware and naive dates are compared by their wall clock time
+        return parse_date(value).replace(tzinfo=None)
+    except (ValueError, OverflowError):
+        abort(400, message=f"{name} is not a valid date")
+
+def parse_ids(value):
+    try:
+        return [int(id) for id in value.split(",") if id.strip()]
+    except ValueError:
+        abort(400, message="ids must be comma separated integers")
+
+# One page of records in id order. The first given filter on an indexed field narrows the scan,
+# the other filters and the since/until range on date_field are checked record by record.
+# With ids (or the ids argument) the records with those ids that pass the filters are returned
+# in the order asked for instead, and the other ids are listed as missing
+def list_entities(repository, args, filters, date_field, ids=None):
+    filters = {k: args[k] for k in filters if args[k] is not None}
+    since = parse_date_arg(args["since"], "since")
+    until = parse_date_arg(args["until"], "until")
+    limit = min(args["limit"], app.config["MAX_PAGE_SIZE"])
+    options = read_options(repository, args)
+
+    def matches(record):
+        if any(record.get(k) != v for k, v in filters.items()):
+            return False
+        if since or until:
+            created = parse_timestamp(record[date_field]).replace(tzinfo=None)
+            if (since and created < since) or (until and created >= until):
+                return False
+        return True
+
+    if ids is None and args["ids"] is not None:
+        ids = parse_ids(args["ids"])
+    if ids is not None:
+        ids = list(dict.fromkeys(ids))
+        if len(ids) > app.config["MAX_BATCH_SIZE"]:
+            abort(400, message=f"At most {app.config['MAX_BATCH_SIZE']} ids can be read at once")
+        found = {id: record for id, record in repository.get_many(ids).items() if matches(record)}
+        items = [found[id] for id in ids if id in found]
+        return {"items": shape_records(repository, items, options, []), "missingIds": [id for id in ids if id not in found]}
+
+    index_field = next((k for k in filters if k in repository.indexed_fields), None)
+    records = repository.scan(index_field, filters.get(index_field), args["after"])
+
+    items = []
+    for record in records:
+        if not matches(record):
+            continue
+        if len(items) == limit:
+            return {"items": shape_records(repository, items, options, []), "nextCursor": items[-1]["id"]}
+        items.append(record)
+    return {"items": shape_records(repository, items, options, []), "nextCursor": None}
+
+# every battery of the pickup is priced against the same reference instant, prices in battery order.
+# Prices of past instants that won't be asked for again are computed without the price cache (cached=False)
+def calculate_battery_prices(calculator, pickup, now, cached=True):
+    if batch_pricing.is_available() and len(pickup["batteries"]) >= app.config["BATCH_PRICING_THRESHOLD"]:
+        return batch_pricing.battery_prices(calculator, pickup["batteries"], now).tolist()
+    if cached and app.config["PRICE_CACHE_SIZE"]:
+        return price_cache.battery_prices(calculator, pickup, now)
+    return calculator.battery_prices(pickup, now)
+
+# counted in a separate pass so the pricing loops stay untouched, only done when metrics are on
+def record_pricing_metrics(calculator, pickup):
+    from_MSRP = sum(1 for b in pickup["batteries"] if calculator.battery_MSRP(b) is not None)
+    metrics.inc("batteries_priced_total", from_MSRP, source="msrp")
+    metrics.inc("batteries_priced_total", len(pickup["batteries"]) - from_MSRP, source="per_kWh")
+
 def generate_quote(pickup):
-    now = datetime.datetime.now().isoformat()
+    issued = datetime.datetime.now()
+    now = issued.isoformat()
+    with metrics.stage("stage_duration_seconds", stage="quote.calculator"):
+        snapshot = active_config.get()
+    with metrics.stage("stage_duration_seconds", stage="quote.price"):
+        battery_prices = calculate_battery_prices(snapshot.calculator, pickup, issued)
+    if metrics.enabled:
+        record_pricing_metrics(snapshot.calculator, pickup)
     new_quote = {
-        "id": next_id(quotes),
-        "quotePrice": QuoteCalculator(quote_configs[max(quote_configs.keys())]).final_quote_price(pickup),
+        "id": quotes.next_id(),
+        # summed in battery order like every pricing engine does, so the total doesn't depend on the engine
+        "quotePrice": sum(battery_prices),
         "quoteIssuedDate": now,
-        "quoteExpiryDate": now,
+        "quoteExpiryDate": (issued + datetime.timedelta(days=app.config["QUOTE_LIFETIME_DAYS"])).isoformat(),
         "sellerId": pickup["ownerId"],
         "associatedPickupId": pickup["id"],
-        "isApproved": False
+        "quoteConfigId": snapshot.id,
+        "isApproved": False,
+        "isExpired": False
     }
+    return new_quote, battery_prices
+
+# returns None if a pickup with that id already exists
+def store_pickup(pickup_id, args):
+    new_pickup = args.copy()
+    now = datetime.datetime.now().isoformat()
+    new_pickup["id"] = pickup_id
+    new_pickup["createdAt"] = now
+    new_pickup["updatedAt"] = now
+
+    if not pickups.add(pickup_id, new_pickup):
+        return None
+    return new_pickup
+
+def issue_quote(pickup):
+    new_quote, battery_prices = generate_quote(pickup)
+    quotes.add(new_quote["id"], new_quote)
+    requoter.index.add(new_quote["id"], pickup["batteries"], new_quote["quoteConfigId"])
+    analytics.add_quote(new_quote, pickup["batteries"], battery_prices)
+    expirer.schedule(new_quote)
     return new_quote
 
-def next_id(repository):
-    return max(repository.keys()) + 1
+def create_pickup(pickup_id, args):
+    new_pickup = store_pickup(pickup_id, args)
+    if new_pickup is None:
+        return None, None
+    return new_pickup, issue_quote(new_pickup)
+
+# the quote is issued by the worker pool, its progress is tracked by a job record
+def start_quote_job(pickup):
+    now = datetime.datetime.now().isoformat()
+    job = {
+        "id": jobs.next_id(),
+        "type": "quote",
+        "status": "pending",
+        "pickupId": pickup["id"],
+        "quoteId": None,
+        "createdAt": now,
+        "updatedAt": now,
+    }
+    jobs.add(job["id"], job)
+    quote_executor.submit(run_quote_job, job["id"], pickup)
+    return job
+
+def run_quote_job(job_id, pickup):
+    try:
+        new_quote = issue_quote(pickup)
+    except Exception as e:
+        jobs.update(job_id, {"status": "failed", "error": str(e), "updatedAt": datetime.datetime.now().isoformat()})
+    else:
+        jobs.update(job_id, {"status": "done", "quoteId": new_quote["id"], "updatedAt": datetime.datetime.now().isoformat()})
+
+requoter = Requoter(quotes, pickups, jobs, calculate_battery_prices, app.config["REQUOTE_WORKERS"])
+
+# battery prices of a quote issued before analytics recorded them, as it was quoted: priced again with
+# the quote's config at the instant it was issued, and scaled to the stored price if it was re-priced since
+def quoted_battery_prices(quote):
+    try:
+        pickup = pickups[quote["associatedPickupId"]]
+        calculator = active_config.snapshot(quote["quoteConfigId"]).calculator
+    except KeyError:
+        return None
+    prices = calculate_battery_prices(calculator, pickup, parse_timestamp(quote["quoteIssuedDate"]), cached=False)
+    total = sum(prices)
+    if total and total != quote["quotePrice"]:
+        prices = [price * quote["quotePrice"] / total for price in prices]
+    return pickup["batteries"], prices
+
+analytics = QuoteAnalytics(quotes, quote_contributions, quoted_battery_prices, app.config["ANALYTICS_REFRESH_SECONDS"])
+requoter.listeners.append(analytics.add_quote)
+
+# expired quotes can't be agreed to, so they are not re-priced either
+expirer = QuoteExpirer(quotes)
+expirer.listeners.append(requoter.index.remove)
+expirer.load()
+
+# makes config_id the active config, returns the requote job when one was started. Open quotes
+# are re-priced if the new config changes their price under the config they were priced with,
+# which may not be the previously active one when that was activated without requoting
+def activate_quote_config(config_id, requote):
+    previous, snapshot = active_config.activate(config_id)
+    if previous.id != snapshot.id:
+        price_cache.clear()
+    requote = requote if requote is not None else app.config["REQUOTE_ON_NEW_CONFIG"]
+    if requote:
+        return requoter.start(snapshot.config, snapshot.calculator, lambda config_id: active_config.snapshot(config_id).config)
+    return None
+quote_executor = ThreadPoolExecutor(max_workers=app.config["QUOTE_WORKERS"], thread_name_prefix="quote")
 
 '''
 Pickup resource defines details of the battery pickup
@@ -236,30 +731,96 @@ class Pickup(Resource):
     entity_name = "Pickup"
 
     def get(self, pickup_id):
-        abort_if_entity_not_found(pickup_id, pickups, self.entity_name)
-        return pickups[pickup_id]
+        return read_record(pickups, pickup_id, self.entity_name)
     
     # batteries are separately validated due to limitations with reqparse
     def post(self, pickup_id):
         abort_if_entity_exists(pickup_id, pickups, self.entity_name)
-        args = pickups_create_args.parse_args()
-        for i in args["batteries"]:
-            try:
-                validate(i, batterySchema)
-            except ValidationError as e:
-                return f"One or more batteries had validation errors: {e}", 400
-        
-        new_pickup = args.copy()
-        now = datetime.datetime.now().isoformat()
-        new_pickup["id"] = next_id(pickups)
-        new_pickup["createdAt"] = now
-        new_pickup["updatedAt"] = now
+        with metrics.stage("stage_duration_seconds", stage="pickup.parse"):
+            args = pickups_create_args.parse_args()
+            options = pickups_options_args.parse_args()
+        with metrics.stage("stage_duration_seconds", stage="pickup.validate"):
+            errors = battery_validation_errors(args["batteries"])
+        if errors:
+            return {"message": "One or more batteries had validation errors", "errors": errors}, 400
+
+        with metrics.stage("stage_duration_seconds", stage="pickup.store"):
+            new_pickup = store_pickup(pickup_id, args)
+        if new_pickup is None:
+            abort(409, message=f"{self.entity_name} with that id already exists")
+
+        if options["async"] if options["async"] is not None else app.config["ASYNC_QUOTES"]:
+            job = start_quote_job(new_pickup)
+            return {**new_pickup, "quoteJobId": job["id"]}, 201
+        with metrics.stage("stage_duration_seconds", stage="pickup.quote"):
+            issue_quote(new_pickup)
+        return new_pickup, 201
+
+'''
+PickupList resource lists pickups, e.g. all pickups of one owner
+'''
+class PickupList(Resource):
+    repository = pickups
+    list_args = pickups_list_args
+    filters = ["ownerId"]
+    date_field = "createdAt"
+
+    def get(self):
+        return list_entities(self.repository, self.list_args.parse_args(), self.filters, self.date_field)
+
+'''
+PickupBulk resource ingests many pickups from an NDJSON body, one pickup per line with its id
+included. Each pickup is validated, stored and quoted as soon as its line is read, and one
+result line is streamed back per pickup, so neither the request nor the response is buffered
+'''
+class PickupBulk(Resource):
+    entity_name = "Pickup"
+
+    def post(self):
+        return Response(stream_with_context(self.ingest(request.stream)), mimetype="application/x-ndjson")
+
+    # the after_request hook runs before the body is streamed, so results are held back until
+    # their writes are journaled. Waiting once per chunk of lines lets one fsync cover the chunk
+    def ingest(self, stream):
+        sync = journal is not None and app.config["JOURNAL_SYNC"]
+        results = []
+        for line_number, line in enumerate(stream, start=1):
+            if not line.strip():
+                continue
+            results.append(fast_json.dumps(self.ingest_line(line_number, line), compact=True) + b"\n")
+            if not sync or len(results) >= app.config["BULK_ACK_LINES"]:
+                yield self.acknowledge(results, sync)
+                results = []
+        if results:
+            yield self.acknowledge(results, sync)
+
+    def acknowledge(self, results, sync):
+        if sync:
+            journal.wait()
+        return b"".join(results)
 
-        pickups[pickup_id] = new_pickup
+    def ingest_line(self, line_number, line):
+        try:
+            pickup = fast_json.loads(line)
+        except ValueError as e:
+            return {"line": line_number, "status": 400, "error": f"Invalid JSON: {e}"}
+        pickup_id = pickup.get("id") if isinstance(pickup, dict) else None
+        if not pickup_validator.is_valid(pickup):
+            metrics.inc("validation_failures_total", schema="pickup")
+            return {"line": line_number, "id": pickup_id, "status": 400, "error": "Validation error",
+                "errors": validation_messages(pickup_validator, pickup)}
+        errors = battery_validation_errors(pickup["batteries"])
+        if errors:
+            return {"line": line_number, "id": pickup_id, "status": 400, "error": "One or more batteries had validation errors",
+                "errors": errors}
+        if pickup_id in pickups:
+            return {"line": line_number, "id": pickup_id, "status": 409, "error": f"{self.entity_name} with that id already exists"}
 
-        new_quote = generate_quote(new_pickup)
-        quotes[new_quote["id"]] = new_quote
-        return pickups[pickup_id], 201
+        args = {k: pickup.get(k) for k in pickupSchema["properties"] if k != "id"}
+        _, new_quote = create_pickup(pickup_id, args)
+        if new_quote is None:
+            return {"line": line_number, "id": pickup_id, "status": 409, "error": f"{self.entity_name} with that id already exists"}
+        return {"line": line_number, "id": pickup_id, "status": 201, "quoteId": new_quote["id"], "quotePrice": new_quote["quotePrice"]}
 
 '''
 User resource defines the seller/owner of the battery who is requesting a quote
@@ -272,21 +833,16 @@ class User(Resource):
         args = users_create_args.parse_args()
         now = datetime.datetime.now().isoformat()
         new_user = args.copy()
-        new_user["id"] = next_id(users)
+        new_user["id"] = user_id
         new_user["createdAt"] = now
         new_user["updatedAt"] = now
         new_user["isActive"] = True
 
-        users[user_id] = new_user
-        return users[user_id], 201
+        add_entity_or_abort(user_id, new_user, users, self.entity_name)
+        return new_user, 201
 
     def get(self, user_id):
-        abort_if_entity_not_found(user_id, users, self.entity_name)
-        user = users[user_id]
-        if user["isActive"]:
-            return users[user_id]
-        else:
-            return 'User is deactived', 404
+        return read_record(users, user_id, self.entity_name, reject=lambda user: None if user["isActive"] else ('User is deactived', 404))
     
     def post(self, user_id):
         abort_if_entity_exists(user_id, users, self.entity_name)
@@ -294,26 +850,28 @@ class User(Resource):
 
     def put(self, user_id):
         if user_id not in users:
-            self.create(self, user_id)
+            return self.create(user_id)
         else:
             args = users_create_args.parse_args()
             now = datetime.datetime.now().isoformat()
             update_user = args.copy()
-            old_user = users[user_id]
-            old_user["updatedAt"] = now
-            old_user["firstName"] = update_user["firstName"]
-            old_user["lastName"] = update_user["lastName"]
-            old_user["businessName"] = update_user["businessName"]
-            old_user["address"] = update_user["address"]
-            old_user["customerType"] = update_user["customerType"]
-            old_user["email"] = update_user["email"]
-            users[user_id] = old_user
-            return users[user_id], 201
+            try:
+                return users.update(user_id, {
+                    "updatedAt": now,
+                    "firstName": update_user["firstName"],
+                    "lastName": update_user["lastName"],
+                    "businessName": update_user["businessName"],
+                    "address": update_user["address"],
+                    "customerType": update_user["customerType"],
+                    "email": update_user["email"],
+                }), 201
+            except KeyError:
+                return self.create(user_id)
     
     # soft deleting only, in case user deletion was done by mistake
     def delete(self, user_id):
         abort_if_entity_not_found(user_id, users, self.entity_name)
-        users[user_id]["isActive"] = False
+        users.update(user_id, {"isActive": False})
         return '', 204
 
 '''
@@ -325,8 +883,19 @@ class Quote(Resource):
     # quotes can only be read via this resource, they are automatically generated
     # on the server side when a pickup order is POSTed
     def get(self, quote_id):
-        abort_if_entity_not_found(quote_id, quotes, self.entity_name)
-        return quotes[quote_id]
+        return read_record(quotes, quote_id, self.entity_name)
+
+'''
+QuoteList resource lists quotes, e.g. all open quotes of one seller or the quote of a pickup
+'''
+class QuoteList(Resource):
+    repository = quotes
+    list_args = quotes_list_args
+    filters = ["sellerId", "associatedPickupId", "isApproved", "isExpired"]
+    date_field = "quoteIssuedDate"
+
+    def get(self):
+        return list_entities(self.repository, self.list_args.parse_args(), self.filters, self.date_field)
 
 '''
 Agreement resource defines acceptance of the provided quote for the user
@@ -334,61 +903,347 @@ Agreement resource defines acceptance of the provided quote for the user
 class Agreement(Resource):
     entity_name = "Agreement"
 
+    # the quote is embedded unless the request says otherwise
     def get(self, agreement_id):
-        abort_if_entity_not_found(agreement_id, agreements, self.entity_name)
-        agreement = agreements[agreement_id]
-        agreement["associatedQuote"] = quotes[agreement["associatedQuoteId"]]
-        return agreement
+        return read_record(agreements, agreement_id, self.entity_name, default_expand="associatedQuote")
     
     def post(self, agreement_id):
         abort_if_entity_exists(agreement_id, agreements, self.entity_name)
         args = agreements_create_args.parse_args()
+        quote_id = args["associatedQuoteId"]
+        abort_if_entity_not_found(quote_id, quotes, Quote.entity_name)
 
         new_agreement = args.copy()
         now = datetime.datetime.now().isoformat()
-        new_agreement["id"] = next_id(agreements)
+        new_agreement["id"] = agreement_id
         new_agreement["createdAt"] = now
         new_agreement["updatedAt"] = now
 
-        agreements[agreement_id] = new_agreement
+        # we mark the associated quote as approved before storing the agreement, checking in the same
+        # step that it is still open, so the expirer or a requote can't change it in between
+        if quotes.update(quote_id, {"isApproved": True, "updatedAt": now},
+                lambda quote: not quote["isApproved"] and not is_expired(quote)) is None:
+            quote = quotes[quote_id]
+            abort(409, message=f"{Quote.entity_name} has expired" if not quote["isApproved"] else f"{Quote.entity_name} has already been agreed to")
+        if not agreements.add(agreement_id, new_agreement):
+            # the expirer skips approved quotes, so the reopened quote is scheduled again
+            expirer.schedule(quotes.update(quote_id, {"isApproved": False, "updatedAt": datetime.datetime.now().isoformat()}))
+            abort(409, message=f"{self.entity_name} with that id already exists")
+        requoter.index.remove(quote_id)
+        analytics.approve(quote_id)
+
+        return new_agreement, 201
+
+'''
+AgreementList resource lists agreements, e.g. the agreement for one quote
+'''
+class AgreementList(Resource):
+    repository = agreements
+    list_args = agreements_list_args
+    filters = ["associatedQuoteId"]
+    date_field = "createdAt"
 
-        # we mark the associated quote as approved
-        quotes[new_agreement["associatedQuoteId"]]["isApproved"] = True
+    def get(self):
+        return list_entities(self.repository, self.list_args.parse_args(), self.filters, self.date_field)
 
-        return agreements[agreement_id], 201
+'''
+UserList resource lists users, deactivated users only when asked for with isActive=false
+'''
+class UserList(Resource):
+    repository = users
+    list_args = users_list_args
+    filters = ["isActive"]
+    date_field = "createdAt"
+
+    def get(self):
+        return list_entities(self.repository, self.list_args.parse_args(), self.filters, self.date_field)
+
+'''
+BatchGet resource reads many records of a list resource by id: POST {"ids": [1, 2, 3]} to
+/<records>:batchGet, for more ids than fit in a ?ids= query. The list resource's query
+arguments (filters, expand, fields) apply as well
+'''
+class BatchGet(Resource):
+    def __init__(self, list_resource):
+        self.list_resource = list_resource
+
+    def post(self):
+        ids = batch_get_args.parse_args()["ids"]
+        if not all(type(id) is int for id in ids):
+            abort(400, message="ids must be a list of integers")
+        list_resource = self.list_resource
+        return list_entities(list_resource.repository, list_resource.list_args.parse_args(), list_resource.filters, list_resource.date_field, ids)
 
 
 class QuoteConfig(Resource):
     entity_name = "QuoteConfig"
 
     def get(self, config_id):
-        abort_if_entity_not_found(config_id, quote_configs, self.entity_name)
-        return quote_configs[config_id]
+        return read_record(quote_configs, config_id, self.entity_name)
     
-    # battery weights are separately validated due to limitations with reqparse
+    # MSRPs, costs and weights are separately validated due to limitations with reqparse, against
+    # the same schema as inline configs of a pricing simulation
     def post(self, config_id):
         abort_if_entity_exists(config_id, quote_configs, self.entity_name)
         args = quote_config_create_args.parse_args()
+        options = quote_config_options_args.parse_args()
+        # a staged config prices nothing, so there is nothing to requote against yet
+        if options["requote"] and not options["activate"]:
+            abort(400, message="requote needs activate, requote when the config is activated through /quoteConfig/active")
 
-        try:
-            validate(args["batteryPropsWeights"], batteryPropsWeightsSchema)
-        except ValidationError as e:
-            return f"One or more batteries had validation errors: {e}", 400
+        if not quote_config_validator.is_valid(args):
+            metrics.inc("validation_failures_total", schema="quoteConfig")
+            errors = validation_messages(quote_config_validator, args)
+            return {"message": "QuoteConfig had validation errors", "errors": errors}, 400
 
         new_config = args.copy()
         now = datetime.datetime.now().isoformat()
-        new_config["id"] = next_id(quote_configs)
+        new_config["id"] = config_id
         new_config["createdAt"] = now
         new_config["updatedAt"] = now
 
-        quote_configs[config_id] = new_config
-        return quote_configs[config_id], 201
+        try:
+            snapshot = ConfigSnapshot(new_config)
+        except ValueError as e:
+            return str(e), 400
+
+        add_entity_or_abort(config_id, new_config, quote_configs, self.entity_name)
+        active_config.snapshots.setdefault(config_id, snapshot)
+
+        if not options["activate"]:
+            return new_config, 201
+        job = activate_quote_config(config_id, options["requote"])
+        if job is not None:
+            return {**new_config, "requoteJobId": job["id"]}, 201
+        return new_config, 201
+
+'''
+ActiveQuoteConfig resource points to the QuoteConfig new quotes are priced with. PUT switches it
+atomically, e.g. to roll back to an earlier config or to go live with a staged one
+'''
+class ActiveQuoteConfig(Resource):
+    def get(self):
+        return active_config.pointer()
+
+    def put(self):
+        args = active_quote_config_args.parse_args()
+        options = quote_config_options_args.parse_args()
+        abort_if_entity_not_found(args["quoteConfigId"], quote_configs, QuoteConfig.entity_name)
+        job = activate_quote_config(args["quoteConfigId"], options["requote"])
+        if job is not None:
+            return {**active_config.pointer(), "requoteJobId": job["id"]}
+        return active_config.pointer()
+
+'''
+Job resource reports the progress of background work: quotes computed for async pickup POSTs
+(pending/done/failed and the resulting quoteId) and re-pricing after a config change
+'''
+class Job(Resource):
+    entity_name = "Job"
+
+    def get(self, job_id):
+        abort_if_entity_not_found(job_id, jobs, self.entity_name)
+        return jobs[job_id]
+
+'''
+PricingSimulation resource prices batteries of existing pickups and inline batteries under
+existing and inline QuoteConfigs, without storing anything. prices has one row per battery and
+one column per config (pickups' batteries first, in order, then the inline ones), and
+pickupTotals the quote price each pickup would get under each config. Configs are listed in
+quoteConfigIds, null for inline ones, and default to the active config
+'''
+class PricingSimulation(Resource):
+    def post(self):
+        # reqparse turns a string into a list of its characters, so the body is checked as sent
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict) or not all(isinstance(body.get(k, []), list) for k in ("pickupIds", "batteries", "quoteConfigIds", "quoteConfigs")):
+            abort(400, message="pickupIds, batteries, quoteConfigIds and quoteConfigs must be lists")
+        args = pricing_simulation_args.parse_args()
+        pickup_ids = args["pickupIds"]
+        config_ids = args["quoteConfigIds"]
+        if not all(type(id) is int for id in pickup_ids + config_ids):
+            abort(400, message="pickupIds and quoteConfigIds must be lists of integers")
+
+        errors = battery_validation_errors(args["batteries"])
+        if errors:
+            return {"message": "One or more batteries had validation errors", "errors": errors}, 400
+        errors = {i: validation_messages(quote_config_validator, c) for i, c in enumerate(args["quoteConfigs"]) if not quote_config_validator.is_valid(c)}
+        if errors:
+            return {"message": "One or more quoteConfigs had validation errors", "errors": errors}, 400
+
+        found = pickups.get_many(pickup_ids)
+        missing = [id for id in pickup_ids if id not in found]
+        if missing:
+            abort(404, message=f"{Pickup.entity_name} {', '.join(map(str, missing))} doesn't exist")
+        missing = [id for id in config_ids if id not in quote_configs]
+        if missing:
+            abort(404, message=f"{QuoteConfig.entity_name} {', '.join(map(str, missing))} doesn't exist")
+        if not config_ids and not args["quoteConfigs"]:
+            config_ids = [active_config.get().id]
+        try:
+            calculators = [active_config.snapshot(id).calculator for id in config_ids]
+            calculators += [ConfigSnapshot({**config, "id": None}).calculator for config in args["quoteConfigs"]]
+        except ValueError as e:
+            abort(400, message=str(e))
+
+        simulated_pickups = [found[id] for id in pickup_ids]
+        batteries = [b for p in simulated_pickups for b in p["batteries"]] + args["batteries"]
+        if len(batteries) * len(calculators) > app.config["MAX_SIMULATION_PRICES"]:
+            abort(400, message=f"At most {app.config['MAX_SIMULATION_PRICES']} prices can be simulated at once")
+
+        now = datetime.datetime.now()
+        try:
+            if batch_pricing.is_available():
+                matrix = batch_pricing.price_matrix(calculators, batteries, now)
+            else:
+                matrix = [[calculator.calculate_battery_price(b, now) for b in batteries] for calculator in calculators]
+        except KeyError as e:
+            # a battery without a listed model is priced per kWh of its chemistry
+            chemistry = e.args[0]
+            configs = [i for i, calculator in enumerate(calculators) if chemistry not in calculator.battery_chemistry_cost_per_kWh]
+            abort(400, message=f"batteryChemistryCostPerkWh has no cost for {chemistry} in the configs at positions {', '.join(map(str, configs))} of quoteConfigIds")
+
+        # summed in battery order, so a total is exactly the price the pickup would be quoted
+        pickup_totals = []
+        start = 0
+        for pickup in simulated_pickups:
+            end = start + len(pickup["batteries"])
+            pickup_totals.append({"pickupId": pickup["id"], "prices": [sum(row[start:end]) for row in matrix]})
+            start = end
+        return {
+            "quoteConfigIds": config_ids + [None] * len(args["quoteConfigs"]),
+            "prices": [list(prices) for prices in zip(*matrix)],
+            "pickupTotals": pickup_totals,
+        }
+
+'''
+QuoteAnalyticsReport resource reports quoted and approved value, battery counts and battery price
+percentiles, grouped by any of chemistry, batteryType, brand and week (quotes' issue week)
+'''
+class QuoteAnalyticsReport(Resource):
+    def get(self):
+        args = quote_analytics_args.parse_args()
+        group_by = [d.strip() for d in args["groupBy"].split(",") if d.strip()]
+        unknown = [d for d in group_by if d not in DIMENSIONS]
+        if unknown:
+            abort(400, message=f"Can't group by {', '.join(unknown)}, use {', '.join(DIMENSIONS)}")
+        since = parse_date_arg(args["since"], "since")
+        until = parse_date_arg(args["until"], "until")
+        return {"groupBy": group_by, "groups": analytics.query(list(dict.fromkeys(group_by)), since, until)}
+
+# quotes are only expired by processes that serve requests, not by one that merely imported the app
+@app.before_request
+def start_expirer():
+    expirer.ensure_started()
+
+# writes are acknowledged once they are on disk, a single fsync covers every request waiting for it
+if journal is not None and app.config["JOURNAL_SYNC"]:
+    @app.after_request
+    def wait_for_journal(response):
+        journal.wait()
+        return response
+
+# per-endpoint request latency, the hooks are only installed when metrics are enabled
+if metrics.enabled:
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def record_request_duration(response):
+        metrics.observe("http_request_duration_seconds", time.perf_counter() - g.request_started,
+            endpoint=request.endpoint or "unmatched", method=request.method, status=response.status_code)
+        return response
+
+# values already counted by the caches, read at scrape time
+def cache_metrics():
+    dates = parse_date.cache_info()
+    return [
+        ("response_cache_requests_total", "counter", "Encoded response cache lookups", [
+            ({"result": "hit"}, response_cache.hits), ({"result": "miss"}, response_cache.misses)]),
+        ("date_parse_cache_requests_total", "counter", "Purchase date parse cache lookups", [
+            ({"result": "hit"}, dates.hits), ({"result": "miss"}, dates.misses)]),
+        ("price_cache_requests_total", "counter", "Battery prices served from the price cache (hit) or computed (miss)", [
+            ({"result": "hit"}, price_cache.hits), ({"result": "miss"}, price_cache.misses)]),
+        ("price_cache_entries", "gauge", "Battery prices in the price cache", [({}, len(price_cache.entries))]),
+    ]
+
+metrics.collectors.append(cache_metrics)
+
+profile_resources = app.config["PROFILE_RESOURCES"]
+if isinstance(profile_resources, str):
+    profile_resources = profile_resources.split(",")
+profiler = RequestProfiler(app.config["PROFILE_MODE"], app.config["PROFILE_RATE"], profile_resources, app.config["PROFILE_SAMPLE_INTERVAL"]) if app.config["PROFILE_ENABLED"] else None
+
+# request profiling, the hooks are only installed when profiling is enabled
+if profiler is not None:
+    @app.before_request
+    def start_request_profile():
+        g.profile = profiler.start(request.endpoint or "")
+
+    @app.teardown_request
+    def stop_request_profile(exc):
+        token = g.pop("profile", None)
+        if token is not None:
+            profiler.stop(token)
+
+'''
+ProfileReport resource serves the profiles aggregated so far. Without a resource it lists how
+many requests were profiled per resource, DELETE starts over
+'''
+class ProfileReport(Resource):
+    def get(self):
+        args = profile_report_args.parse_args()
+        if args["resource"] is None:
+            return profiler.summary()
+
+        resource = args["resource"].lower()
+        if args["format"] == "collapsed":
+            if profiler.mode != "sample":
+                abort(400, message="Collapsed stacks are only recorded in sample mode")
+            report = profiler.collapsed(resource)
+            mimetype = "text/plain"
+        elif profiler.mode != "cprofile":
+            abort(400, message="pstats reports are only recorded in cprofile mode")
+        elif args["format"] == "pstats":
+            report = profiler.pstats_dump(resource)
+            mimetype = "application/octet-stream"
+        else:
+            report = profiler.pstats_report(resource, args["sort"], args["limit"])
+            mimetype = "text/plain"
+
+        if report is None:
+            abort(404, message=f"No profiles recorded for {args['resource']}")
+        return Response(report, mimetype=mimetype)
+
+    def delete(self):
+        profiler.reset()
+        return "", 204
+
+@app.route("/metrics")
+def metrics_endpoint():
+    if not metrics.enabled:
+        abort(404, message="Metrics are disabled")
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
 
 api.add_resource(Pickup, "/pickup/<int:pickup_id>")
+api.add_resource(PickupList, "/pickups")
+api.add_resource(PickupBulk, "/pickups/bulk")
 api.add_resource(User, "/user/<int:user_id>")
+api.add_resource(UserList, "/users")
 api.add_resource(Quote, "/quote/<int:quote_id>")
+api.add_resource(QuoteList, "/quotes")
 api.add_resource(Agreement, "/agreement/<int:agreement_id>")
+api.add_resource(AgreementList, "/agreements")
 api.add_resource(QuoteConfig, "/quoteConfig/<int:config_id>")
+api.add_resource(ActiveQuoteConfig, "/quoteConfig/active")
+api.add_resource(Job, "/job/<int:job_id>")
+api.add_resource(QuoteAnalyticsReport, "/analytics/quotes")
+api.add_resource(PricingSimulation, "/pricing/simulate")
+for list_resource, path in [(UserList, "/users"), (PickupList, "/pickups"), (QuoteList, "/quotes"), (AgreementList, "/agreements")]:
+    api.add_resource(BatchGet, f"{path}:batchGet", endpoint=f"{path[1:]}_batch_get", resource_class_args=(list_resource,))
+if profiler is not None:
+    api.add_resource(ProfileReport, "/admin/profile")
 
 if __name__ == "__main__":
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,122 @@
+from contextlib import nullcontext
+import threading
+import time
+
+"""
+Built-in metrics in the Prometheus text format. Nothing is recorded unless metrics are enabled:
+stage() then hands out a shared no-op context and the request hooks are never installed, so the
+instrumented code paths cost next to nothing when nobody scrapes /metrics.
+"""
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+DISABLED = nullcontext()
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+# labels are (name, value) pairs
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{escape_label(v)}"' for k, v in labels) + "}"
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+'''
+Timer records the time spent in a with block into a histogram
+'''
+class Timer:
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.started, **self.labels)
+
+'''
+Metrics holds counters and histograms keyed by name and label values. Collectors are called at
+scrape time and return (name, type, help, [(labels, value)]) for values kept elsewhere
+'''
+class Metrics:
+    def __init__(self, enabled=False, namespace="batteria"):
+        self.enabled = enabled
+        self.namespace = namespace
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.help = {}
+        self.collectors = []
+
+    def describe(self, name, help):
+        self.help[name] = help
+
+    def inc(self, name, amount=1, **labels):
+        if not self.enabled:
+            return
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    def observe(self, name, seconds, **labels):
+        if not self.enabled:
+            return
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            buckets = series.get(key)
+            if buckets is None:
+                buckets = series[key] = [[0] * len(DEFAULT_BUCKETS), 0.0, 0]
+            for i, bound in enumerate(DEFAULT_BUCKETS):
+                if seconds <= bound:
+                    buckets[0][i] += 1
+                    break
+            buckets[1] += seconds
+            buckets[2] += 1
+
+    # times a with block into the <name> histogram, e.g. with metrics.stage("stage_duration_seconds", stage="validate")
+    def stage(self, name, **labels):
+        if not self.enabled:
+            return DISABLED
+        return Timer(self, name, labels)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            counters = {name: dict(series) for name, series in self.counters.items()}
+            histograms = {name: {k: (list(b[0]), b[1], b[2]) for k, b in series.items()} for name, series in self.histograms.items()}
+
+        for name, series in sorted(counters.items()):
+            self.render_header(lines, name, "counter")
+            for labels, value in sorted(series.items()):
+                lines.append(f"{self.namespace}_{name}{format_labels(labels)} {format_value(value)}")
+
+        for name, series in sorted(histograms.items()):
+            self.render_header(lines, name, "histogram")
+            for labels, (buckets, total, count) in sorted(series.items()):
+                cumulative = 0
+                for bound, bucket in zip(DEFAULT_BUCKETS, buckets):
+                    cumulative += bucket
+                    lines.append(f"{self.namespace}_{name}_bucket{format_labels(labels + (('le', str(bound)),))} {cumulative}")
+                lines.append(f"{self.namespace}_{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {count}")
+                lines.append(f"{self.namespace}_{name}_sum{format_labels(labels)} {format_value(total)}")
+                lines.append(f"{self.namespace}_{name}_count{format_labels(labels)} {count}")
+
+        for collector in self.collectors:
+            for name, type, help, samples in collector():
+                lines.append(f"# HELP {self.namespace}_{name} {help}")
+                lines.append(f"# TYPE {self.namespace}_{name} {type}")
+                for labels, value in samples:
+                    lines.append(f"{self.namespace}_{name}{format_labels(tuple(labels.items()))} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def render_header(self, lines, name, type):
+        if name in self.help:
+            lines.append(f"# HELP {self.namespace}_{name} {self.help[name]}")
+        lines.append(f"# TYPE {self.namespace}_{name} {type}")
@@ -0,0 +1,62 @@
+from collections import OrderedDict
+import threading
+from quote_dates import reference_now
+
+"""
+Price cache for repetitive pickups. Fleet and commercial pickups hold many identical batteries,
+so battery prices are memoized under the calculator they were computed with (one per config
+snapshot) and the battery's price fingerprint (QuoteCalculator.price_fingerprints). Prices come
+from the same calculator code, so a cached quote is exactly the quote computed from scratch.
+"""
+
+'''
+PriceCache is a thread-safe LRU of battery prices
+'''
+class PriceCache:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    # same result as calculator.final_quote_price(pickup, now), pricing each distinct battery once
+    def final_quote_price(self, calculator, pickup, now=None):
+        # summed in battery order, like the calculator does
+        return sum(self.battery_prices(calculator, pickup, now))
+
+    # same result as calculator.battery_prices(pickup, now)
+    def battery_prices(self, calculator, pickup, now=None):
+        now = reference_now(now)
+        batteries = pickup["batteries"]
+        keys = [(calculator, fingerprint) for fingerprint in calculator.price_fingerprints(batteries, now)]
+
+        # first battery of each fingerprint
+        distinct = {}
+        for key, battery in zip(keys, batteries):
+            distinct.setdefault(key, battery)
+
+        prices = {}
+        with self.lock:
+            for key in distinct:
+                price = self.entries.get(key)
+                if price is not None:
+                    self.entries.move_to_end(key)
+                    prices[key] = price
+
+        computed = {key: calculator.calculate_battery_price(battery, now) for key, battery in distinct.items() if key not in prices}
+        prices.update(computed)
+
+        with self.lock:
+            self.hits += len(batteries) - len(computed)
+            self.misses += len(computed)
+            for key, price in computed.items():
+                self.entries[key] = price
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return [prices[key] for key in keys]
+
+    # called when the active config changes, prices of the previous config are rarely needed again
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
@@ -0,0 +1,149 @@
+from collections import Counter
+import cProfile
+import io
+import marshal
+import pstats
+import random
+import sys
+import threading
+import time
+
+"""
+On-demand profiling of live requests. A fraction of the requests to selected resources are
+profiled, either with cProfile (exact call counts, reported as pstats) or with a sampler thread
+that snapshots the request's stack every few milliseconds (reported as collapsed stacks, the
+input format of flamegraph.pl and speedscope). Results are aggregated in memory per resource.
+When profiling is disabled the request hooks are never installed.
+"""
+
+MODES = ["cprofile", "sample"]
+
+# "file:function:line" frames from the outermost call down, as flamegraph tools expect
+def collapse_stack(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_filename.rsplit('/', 1)[-1]}:{code.co_name}:{frame.f_lineno}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+'''
+Sampler walks the stacks of the threads currently serving profiled requests. The thread is
+started with the first profiled request and only wakes up every interval seconds
+'''
+class Sampler:
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.active = {}
+        self.stacks = {}
+        self.thread = None
+
+    def start(self, resource):
+        with self.lock:
+            self.active[threading.get_ident()] = resource
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="profile-sampler", daemon=True)
+                self.thread.start()
+
+    def stop(self):
+        with self.lock:
+            self.active.pop(threading.get_ident(), None)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                if not self.active:
+                    continue
+                frames = sys._current_frames()
+                for ident, resource in self.active.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        self.stacks.setdefault(resource, Counter())[collapse_stack(frame)] += 1
+
+'''
+RequestProfiler decides which requests are profiled and keeps the aggregated results.
+resources are flask_restful endpoint names (the lowercased Resource class name)
+'''
+class RequestProfiler:
+    def __init__(self, mode="cprofile", rate=0.01, resources=(), sample_interval=0.005):
+        if mode not in MODES:
+            raise ValueError(f"Profiling mode must be one of {', '.join(MODES)}")
+        self.mode = mode
+        self.rate = rate
+        self.resources = {r.lower() for r in resources}
+        self.lock = threading.Lock()
+        self.requests = Counter()
+        self.stats = {}
+        self.sampler = Sampler(sample_interval) if mode == "sample" else None
+        # before Python 3.12 only one cProfile profiler can be active at a time,
+        # requests arriving while another one is profiled are skipped
+        self.profiling = threading.Lock()
+
+    def should_profile(self, resource):
+        return resource in self.resources and random.random() < self.rate
+
+    # returns a token to pass to stop(), or None when the request isn't profiled
+    def start(self, resource):
+        if not self.should_profile(resource):
+            return None
+        if self.sampler is not None:
+            self.sampler.start(resource)
+            return (resource, None)
+        if not self.profiling.acquire(blocking=False):
+            return None
+        profile = cProfile.Profile()
+        profile.enable()
+        return (resource, profile)
+
+    def stop(self, token):
+        resource, profile = token
+        if profile is not None:
+            profile.disable()
+            self.profiling.release()
+        else:
+            self.sampler.stop()
+        with self.lock:
+            self.requests[resource] += 1
+            if profile is not None:
+                if resource in self.stats:
+                    self.stats[resource].add(profile)
+                else:
+                    self.stats[resource] = pstats.Stats(profile)
+
+    def reset(self):
+        with self.lock:
+            self.requests.clear()
+            self.stats.clear()
+        if self.sampler is not None:
+            with self.sampler.lock:
+                self.sampler.stacks.clear()
+
+    def summary(self):
+        with self.lock:
+            return {"mode": self.mode, "rate": self.rate, "resources": sorted(self.resources), "profiledRequests": dict(self.requests)}
+
+    # cProfile results as a printed pstats report, sorted by sort_key
+    def pstats_report(self, resource, sort_key="cumulative", limit=50):
+        with self.lock:
+            stats = self.stats.get(resource)
+            if stats is None:
+                return None
+            out = io.StringIO()
+            stats.stream = out
+            stats.sort_stats(sort_key).print_stats(limit)
+        return out.getvalue()
+
+    # cProfile results in the binary format pstats.Stats() and snakeviz can load
+    def pstats_dump(self, resource):
+        with self.lock:
+            stats = self.stats.get(resource)
+            return None if stats is None else marshal.dumps(stats.stats)
+
+    def collapsed(self, resource):
+        with self.sampler.lock:
+            stacks = self.sampler.stacks.get(resource)
+            if stacks is None:
+                return None
+            return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
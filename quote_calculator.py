@@ -1,74 +1,188 @@
-from dateutil import parser
-import datetime
+from operator import attrgetter, itemgetter
+from quote_dates import days_since, reference_now
+from records import Battery, BATTERY_TYPES, CHEMISTRIES, CONDITIONS
 
 """
 Quote Calculator gives the estimated price for a pickup order given a quote configuration
+
+The configuration is compiled once when the calculator is built: weights are normalized
+and every weighted property is paired with its scoring rule, so scoring a battery is a
+single pass over a precomputed list. Calculators are immutable after construction and
+are meant to be cached and shared for as long as their config is in use.
+
+Compact Battery records (records.py) are priced from their slots, with the lookup tables
+indexed by the enum codes they store, in the same order of operations as dict batteries.
 """
+
+CHEMISTRY_SCORES = {
+    "LiFePO4": 1,
+    "Li-ion": 1,
+    "NiCd": 0.85,
+    "NiMH": 0.95
+}
+
+BATTERY_TYPE_SCORES = {
+    "EV": 1,
+    "Home": 1,
+    "BatteryBackup": 0.65,
+}
+
+CONDITION_ORIGINALLY_PURCHASED_SCORES = {
+    "New": 1,
+    "LikeNew": 0.9,
+    "Used": 0.55,
+}
+
+# property -> (greater than threshold?, threshold, score if rule holds, score otherwise)
+THRESHOLD_RULES = {
+    "weightLbs": (True, 50, 0.9, 0.5),
+    "inputVoltage": (True, 110, 0.9, 0.5),
+    "outputVoltage": (True, 110, 0.9, 0.5),
+    "markedCapacitykWh": (True, 50, 0.9, 0.5),
+    "approxLengthUsedDays": (False, 2000, 0.9, 0.5),
+}
+
+PURCHASE_AGE_THRESHOLD_DAYS = 1000
+
+# base price fields of a battery, in the order calculate_battery_base_price uses them
+BASE_PRICE_FIELDS = ("brand", "vehicleMake", "model", "vehicleModel", "chemistry", "markedCapacitykWh")
+
+
+# rules score one property value, now is the reference instant shared by the whole quote
+def lookup_rule(table):
+    return lambda value, now: table[value]
+
+def threshold_rule(greater_than, threshold, passed, failed):
+    if greater_than:
+        return lambda value, now: passed if value > threshold else failed
+    return lambda value, now: passed if value < threshold else failed
+
+def date_purchased_rule(value, now):
+    return 0.9 if days_since(value, now) < PURCHASE_AGE_THRESHOLD_DAYS else 0.5
+
+def is_functioning_rule(value, now):
+    return 0.9 if value else 0.2
+
+# getter returning a tuple of the attributes, whatever their number
+def attributes(fields):
+    getter = attrgetter(*fields) if fields else lambda record: ()
+    return getter if len(fields) > 1 else lambda record: (getter(record),)
+
+
 class QuoteCalculator:
     def __init__(self, config):
         self.battery_model_MSRPs = config["batteryModelMSRPs"]
         self.battery_chemistry_cost_per_kWh = config["batteryChemistryCostPerkWh"]
         self.battery_props_weights = config["batteryPropsWeights"]
-        self.chemistry_scores = {
-            "LiFePO4": 1,
-            "Li-ion": 1,
-            "NiCd": 0.85,
-            "NiMH": 0.95
-        }
-        self.battery_type_scores = {
-            "EV": 1,
-            "Home": 1,
-            "BatteryBackup": 0.65,
+        self.chemistry_scores = CHEMISTRY_SCORES
+        self.battery_type_scores = BATTERY_TYPE_SCORES
+        self.condition_originally_purchased_scores = CONDITION_ORIGINALLY_PURCHASED_SCORES
+        self.rules = {
+            "chemistry": lookup_rule(self.chemistry_scores),
+            "batteryType": lookup_rule(self.battery_type_scores),
+            "dateOriginallyPurchased": date_purchased_rule,
+            "isFunctioning": is_functioning_rule,
+            "conditionOriginallyPurchased": lookup_rule(self.condition_originally_purchased_scores),
         }
-        self.condition_originally_purchased_scores = {
-            "New": 1,
-            "LikeNew": 0.9,
-            "Used": 0.55,
+        for k, rule in THRESHOLD_RULES.items():
+            self.rules[k] = threshold_rule(*rule)
+        self.weighted_rules = self.compile_weights()
+        # the same rules on compact batteries, enum fields are scored by code
+        compact_rules = {
+            "chemistry": lookup_rule(tuple(self.chemistry_scores[v] for v in CHEMISTRIES)),
+            "batteryType": lookup_rule(tuple(self.battery_type_scores[v] for v in BATTERY_TYPES)),
+            "conditionOriginallyPurchased": lookup_rule(tuple(self.condition_originally_purchased_scores[v] for v in CONDITIONS)),
         }
+        self.compact_weighted_rules = [(compact_rules.get(k, rule), weight) for k, rule, weight in self.weighted_rules]
+        self.compact_getter = attributes([k for k, _, _ in self.weighted_rules])
+        self.base_price_getter = attrgetter(*BASE_PRICE_FIELDS)
+        # the battery fields a price depends on under these weights, see price_fingerprint
+        self.fingerprint_fields = [k for k, _, _ in self.weighted_rules if k != "dateOriginallyPurchased"]
+        self.purchase_date_weighted = len(self.fingerprint_fields) < len(self.weighted_rules)
+        self.fingerprint_getter = itemgetter(*BASE_PRICE_FIELDS, *self.fingerprint_fields)
+        self.compact_fingerprint_getter = attrgetter(*BASE_PRICE_FIELDS, *self.fingerprint_fields)
+
+    # normalizing the config weights once, in config order, so scores add up exactly as before
+    def compile_weights(self):
+        divisor = sum(self.battery_props_weights.values())
+        if not divisor:
+            raise ValueError("Battery property weights must not sum to zero")
+        # properties without a rule score 0 and only count towards the divisor
+        return [(k, self.rules[k], v/divisor) for k, v in self.battery_props_weights.items() if k in self.rules]
 
     # scoring the quality of the battery using the config weights
-    def calculate_battery_score(self, battery):
+    def calculate_battery_score(self, battery, now=None):
+        now = reference_now(now)
         score = 0
-        divisor = sum(self.battery_props_weights.values())
-        for k, v in self.battery_props_weights.items():
-            adjusted_weight = v/divisor
-            raw_score = 0
-            match k:
-                case "chemistry":
-                    raw_score = self.chemistry_scores[battery[k]]
-                case "batteryType":
-                    raw_score = self.battery_type_scores[battery[k]]
-                case "weightLbs":
-                    raw_score = (0.9 if battery[k] > 50 else 0.5)
-                case "inputVoltage":
-                    raw_score= (0.9 if battery[k] > 110 else 0.5)
-                case "outputVoltage":
-                    raw_score = (0.9 if battery[k] > 110 else 0.5)
-                case "markedCapacitykWh":
-                    raw_score = (0.9 if battery[k] > 50 else 0.5)
-                case "approxLengthUsedDays":
-                    raw_score = (0.9 if battery[k] < 2000 else 0.5)
-                case "dateOriginallyPurchased":
-                    raw_score = (0.9 if (datetime.datetime.now() - parser.parse(battery[k])).days < 1000 else 0.5)
-                case "isFunctioning":
-                    raw_score = (0.9 if battery[k] else 0.2)
-                case "conditionOriginallyPurchased":
-                    raw_score = (self.condition_originally_purchased_scores[battery[k]])
-            score += (raw_score * adjusted_weight)
+        for k, rule, adjusted_weight in self.weighted_rules:
+            score += (rule(battery[k], now) * adjusted_weight)
         return score
-    
-    # assigning a base price for the battery, then scaling it by the score above
-    def calculate_battery_price(self, battery):
-        battery_base_price = 0
+
+    # MSRP of the battery's brand and model from the config, None if it isn't listed
+    def battery_MSRP(self, battery):
         battery_model = battery["model"] or battery["vehicleModel"]
         battery_brand = battery["brand"] or battery["vehicleMake"]
-        if battery_brand in self.battery_model_MSRPs and battery_model in self.battery_model_MSRPs[battery_brand]:
-            battery_base_price = self.battery_model_MSRPs[battery_brand][battery_model]
-        else:
-            battery_base_price = self.battery_chemistry_cost_per_kWh[battery["chemistry"]] * battery["markedCapacitykWh"]
-        battery_score = self.calculate_battery_score(battery)
-        return battery_score * battery_base_price
+        return self.model_MSRP(battery_brand, battery_model)
+
+    def model_MSRP(self, battery_brand, battery_model):
+        brand_MSRPs = self.battery_model_MSRPs.get(battery_brand)
+        if brand_MSRPs is not None:
+            return brand_MSRPs.get(battery_model)
+        return None
+
+    # Batteries with equal fingerprints get exactly the same price at now. The purchase date only
+    # counts through its score (scored once per distinct date), so batteries bought on different
+    # days can share a fingerprint. Compact batteries hold enum codes, so their fingerprints are
+    # tagged to never match a dict battery's
+    def price_fingerprints(self, batteries, now):
+        fields = self.fingerprint_getter
+        compact_fields = self.compact_fingerprint_getter
+        fingerprints = [(Battery, compact_fields(b)) if type(b) is Battery else fields(b) for b in batteries]
+        if not self.purchase_date_weighted:
+            return fingerprints
+        date_scores = {}
+        scores = []
+        for b in batteries:
+            date = b.dateOriginallyPurchased if type(b) is Battery else b["dateOriginallyPurchased"]
+            score = date_scores.get(date)
+            if score is None:
+                score = date_scores[date] = date_purchased_rule(date, now)
+            scores.append(score)
+        return list(zip(scores, fingerprints))
+
+    # assigning a base price for the battery, then scaling it by the score above
+    def calculate_battery_base_price(self, battery):
+        battery_MSRP = self.battery_MSRP(battery)
+        if battery_MSRP is not None:
+            return battery_MSRP
+        return self.battery_chemistry_cost_per_kWh[battery["chemistry"]] * battery["markedCapacitykWh"]
+
+    def calculate_battery_price(self, battery, now=None):
+        if type(battery) is Battery:
+            return self.calculate_compact_battery_price(battery, reference_now(now))
+        battery_score = self.calculate_battery_score(battery, now)
+        return battery_score * self.calculate_battery_base_price(battery)
+
+    # calculate_battery_price reading the slots of a compact Battery in one go
+    def calculate_compact_battery_price(self, battery, now):
+        try:
+            values = self.compact_getter(battery)
+            brand, vehicle_make, model, vehicle_model, chemistry, capacity = self.base_price_getter(battery)
+        except AttributeError as e:
+            raise KeyError(e.name) from None
+        battery_score = 0
+        for (rule, adjusted_weight), value in zip(self.compact_weighted_rules, values):
+            battery_score += (rule(value, now) * adjusted_weight)
+        battery_MSRP = self.model_MSRP(brand or vehicle_make, model or vehicle_model)
+        if battery_MSRP is None:
+            battery_MSRP = self.battery_chemistry_cost_per_kWh[CHEMISTRIES[chemistry]] * capacity
+        return battery_score * battery_MSRP
+
+    # the price of every battery of the pickup, in order
+    def battery_prices(self, pickup, now=None):
+        now = reference_now(now)
+        return [self.calculate_battery_price(b, now) for b in pickup["batteries"]]
 
     # sum all the batteries' prices for the given pickup order
-    def final_quote_price(self, pickup):
-        return sum([self.calculate_battery_price(b) for b in pickup["batteries"]])
\ No newline at end of file
+    def final_quote_price(self, pickup, now=None):
+        return sum(self.battery_prices(pickup, now))
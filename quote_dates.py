@@ -0,0 +1,33 @@
+from dateutil import parser
+from functools import lru_cache
+import datetime
+
+"""
+Date handling for quoting. Purchase dates are almost always ISO-8601, which the stdlib parses
+far faster than dateutil's fuzzy parser, so dateutil is only the fallback for odd inputs.
+Parsed dates are memoized in a bounded cache since the same dates repeat across pickups.
+
+Timestamps the server writes itself (createdAt, updatedAt, quote issue and expiry dates) are
+always isoformat() output and all but unique to their record, so parse_timestamp parses them
+without the cache, where they would only evict purchase dates.
+"""
+
+PURCHASE_DATE_CACHE_SIZE = 4096
+
+@lru_cache(maxsize=PURCHASE_DATE_CACHE_SIZE)
+def parse_date(value):
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except ValueError:
+        return parser.parse(value)
+
+def parse_timestamp(value):
+    return datetime.datetime.fromisoformat(value)
+
+# whole days between the date and the quote's reference instant
+def days_since(value, now):
+    return (now - parse_date(value)).days
+
+# every battery of a quote is scored against the same instant
+def reference_now(now=None):
+    return now or datetime.datetime.now()
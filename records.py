@@ -0,0 +1,139 @@
+from collections.abc import Mapping
+import sys
+
+"""
+Compact record types for the memory backend. A record is stored as an object with one slot per
+field instead of a dict, enum-like fields hold a small integer code, and repeated free text
+(brands, models, dates) is interned so each distinct value is stored once. The types are
+read-only Mappings, so code written against dict records reads them unchanged, and they are
+turned back into dicts when encoded as JSON. Records with fields or values a type doesn't know
+stay plain dicts.
+"""
+
+# distinct key orders kept per record type, records with the same order share one tuple
+MAX_KEY_ORDERS = 1024
+
+BATTERY_FIELDS = [
+    "chemistry",
+    "batteryType",
+    "ownerId",
+    "brand",
+    "model",
+    "vehicleMake",
+    "vehicleModel",
+    "weightLbs",
+    "inputVoltage",
+    "outputVoltage",
+    "markedCapacitykWh",
+    "approxLengthUsedDays",
+    "dateOriginallyPurchased",
+    "isFunctioning",
+    "conditionOriginallyPurchased",
+    "comments",
+]
+
+# codes are positions in these tuples, in the order of the quote calculator's score tables
+CHEMISTRIES = ("LiFePO4", "Li-ion", "NiCd", "NiMH")
+BATTERY_TYPES = ("EV", "Home", "BatteryBackup")
+CONDITIONS = ("New", "LikeNew", "Used")
+CUSTOMER_TYPES = ("Residential", "Business")
+PAYMENT_METHODS = ("Check", "GiftCard", "Cash", "Crypto")
+
+'''
+CompactRecord is the base of the record types. Subclasses list their fields in __slots__,
+enum fields with their values in enums, text fields to intern in interned, and fields
+converted on the way in (e.g. nested records) in converters. Keys are iterated in the order
+the record had as a dict, so it encodes to the same JSON
+'''
+class CompactRecord(Mapping):
+    __slots__ = ("key_order",)
+    enums = {}
+    interned = ()
+    converters = {}
+
+    def __init_subclass__(cls):
+        cls.slots = {field: cls.__dict__[field] for field in cls.__slots__}
+        cls.codes = {field: {v: i for i, v in enumerate(values)} for field, values in cls.enums.items()}
+        cls.interned = frozenset(cls.interned)
+        cls.key_orders = {}
+
+    # the compact form of record, None if it doesn't fit this type
+    @classmethod
+    def from_dict(cls, record):
+        slots = cls.slots
+        compact = cls.__new__(cls)
+        for k, v in record.items():
+            slot = slots.get(k)
+            if slot is None:
+                return None
+            codes = cls.codes.get(k)
+            if codes is not None:
+                v = codes.get(v) if type(v) is str else None
+                if v is None:
+                    return None
+            elif k in cls.converters:
+                v = cls.converters[k](v)
+            elif type(v) is str and k in cls.interned:
+                v = sys.intern(v)
+            slot.__set__(compact, v)
+        key_order = tuple(record)
+        if len(cls.key_orders) < MAX_KEY_ORDERS:
+            key_order = cls.key_orders.setdefault(key_order, key_order)
+        compact.key_order = cls.key_orders.get(key_order, key_order)
+        return compact
+
+    def __getitem__(self, key):
+        try:
+            value = self.slots[key].__get__(self)
+        except (KeyError, AttributeError):
+            raise KeyError(key) from None
+        values = self.enums.get(key)
+        return value if values is None else values[value]
+
+    def __iter__(self):
+        return iter(self.key_order)
+
+    def __len__(self):
+        return len(self.key_order)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({dict(self)!r})"
+
+class Battery(CompactRecord):
+    __slots__ = tuple(BATTERY_FIELDS)
+    enums = {"chemistry": CHEMISTRIES, "batteryType": BATTERY_TYPES, "conditionOriginallyPurchased": CONDITIONS}
+    interned = ("brand", "model", "vehicleMake", "vehicleModel", "dateOriginallyPurchased")
+
+# batteries that don't fit the compact type are kept as they are
+def compact_batteries(batteries):
+    return tuple(Battery.from_dict(b) or b if type(b) is dict else b for b in batteries)
+
+class Pickup(CompactRecord):
+    __slots__ = ("id", "ownerId", "pickUpAddress", "batteries", "addressType", "requestedPickupDate", "comments", "createdAt", "updatedAt")
+    enums = {"addressType": CUSTOMER_TYPES}
+    converters = {"batteries": compact_batteries}
+
+class User(CompactRecord):
+    __slots__ = ("id", "firstName", "lastName", "businessName", "address", "customerType", "email", "createdAt", "updatedAt", "isActive")
+    enums = {"customerType": CUSTOMER_TYPES}
+
+class Quote(CompactRecord):
+    __slots__ = ("id", "quotePrice", "quoteIssuedDate", "quoteExpiryDate", "sellerId", "associatedPickupId", "quoteConfigId", "isApproved", "isExpired", "updatedAt")
+
+class Agreement(CompactRecord):
+    __slots__ = ("id", "associatedQuoteId", "agreedDate", "paymentMethod", "comments", "createdAt", "updatedAt")
+    enums = {"paymentMethod": PAYMENT_METHODS}
+
+# repository name -> record type
+COMPACT_TYPES = {
+    "users": User,
+    "pickups": Pickup,
+    "quotes": Quote,
+    "agreements": Agreement,
+}
+
+def compact(name, record):
+    record_type = COMPACT_TYPES.get(name)
+    if record_type is None or type(record) is not dict:
+        return record
+    return record_type.from_dict(record) or record
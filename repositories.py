@@ -0,0 +1,464 @@
+from bisect import bisect_right, insort
+from collections.abc import MutableMapping
+import itertools
+import json
+import secrets
+import sqlite3
+import threading
+from records import BATTERY_FIELDS, compact
+
+"""
+Repositories store the API's records keyed by id. Both backends behave like the dicts they
+replace, so resources read, write and check ids the same way whichever backend is configured.
+Records read from SQLite are fresh copies, so changes must be written back with repository[id] = record.
+
+Creates and updates that can race go through add() and update(), which are atomic in both
+backends, and server-side ids come from next_id(), which never hands out the same id twice.
+An update that only applies while the record is in some state passes update() a condition,
+checked in the same atomic step as the write. Changes that depend on when they are written (like
+an updatedAt timestamp) can be passed as a function, called in that step too.
+
+scan() walks records in id order starting after a cursor id, optionally only those with a
+given value in one of the INDEXED_FIELDS, which is what keyset-paginated listings are built on.
+
+Every write bumps the record's version (get_versioned() returns both) and calls the repository's
+listeners with (repository name, id), so caches can be validated and invalidated. Versions are only
+comparable under the same epoch: None where they are stored with the records, otherwise a token
+chosen when the repository is created.
+"""
+
+LOCK_STRIPES = 64
+SCAN_CHUNK_SIZE = 100
+# ids per query of a SQLite get_many, well below SQLite's limit on bound parameters
+GET_MANY_CHUNK_SIZE = 500
+
+# record fields copied into their own indexed columns, per table
+INDEXED_FIELDS = {
+    "users": [],
+    "pickups": ["ownerId"],
+    "quotes": ["sellerId", "associatedPickupId"],
+    "agreements": ["associatedQuoteId"],
+    "quote_configs": [],
+    "jobs": [],
+    "settings": [],
+    "quote_contributions": [],
+}
+
+'''
+IdAllocator is an atomic counter seeded with the highest id in use
+'''
+class IdAllocator:
+    def __init__(self, start=1):
+        self.lock = threading.Lock()
+        self.next = start
+
+    def allocate(self):
+        with self.lock:
+            id = self.next
+            self.next += 1
+            return id
+
+    # ids chosen by clients are skipped by later allocations
+    def observe(self, id):
+        with self.lock:
+            if id >= self.next:
+                self.next = id + 1
+
+'''
+InMemoryRepository keeps records in a plain dict, lost on restart. With compact_records they
+are stored in the compact form from records.py
+'''
+class InMemoryRepository(MutableMapping):
+    # records are only visible to this process
+    shared = False
+
+    def __init__(self, name, seed=None, compact_records=False):
+        self.name = name
+        self.compact_records = compact_records
+        self.locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        self.index_lock = threading.Lock()
+        self.indexed_fields = INDEXED_FIELDS.get(name, [])
+        # versions come from one counter per repository, so a rewritten record never reuses one.
+        # The counter starts over (and restored records are renumbered) on every boot, hence the epoch
+        self.version_counter = itertools.count(1)
+        self.epoch = secrets.token_hex(4)
+        self.reset(seed or {})
+        self.listeners = []
+
+    # replaces every record, e.g. with the state restored from a journal. Listeners aren't told
+    def reset(self, records):
+        self.records = {id: self.compact(record) for id, record in records.items()}
+        self.ids = IdAllocator(max(self.records, default=0) + 1)
+        # secondary indexes hold sorted id lists, for all records and per indexed field value
+        self.sorted_ids = []
+        self.indexes = {field: {} for field in self.indexed_fields}
+        for id in sorted(self.records):
+            self.reindex(id, None, self.records[id])
+        self.versions = {id: next(self.version_counter) for id in self.records}
+
+    def lock_for(self, id):
+        return self.locks[hash(id) % LOCK_STRIPES]
+
+    def compact(self, record):
+        return compact(self.name, record) if self.compact_records else record
+
+    def after_fork(self):
+        pass
+
+    def next_id(self):
+        return self.ids.allocate()
+
+    # moves the id between index entries when a record is added, changed or removed
+    def reindex(self, id, old, new):
+        with self.index_lock:
+            if old is None:
+                insort(self.sorted_ids, id)
+            elif new is None:
+                del self.sorted_ids[bisect_right(self.sorted_ids, id) - 1]
+            for field, index in self.indexes.items():
+                old_value = old.get(field) if old is not None else None
+                new_value = new.get(field) if new is not None else None
+                if old is not None and (new is None or old_value != new_value):
+                    ids = index[old_value]
+                    del ids[bisect_right(ids, id) - 1]
+                    if not ids:
+                        del index[old_value]
+                if new is not None and (old is None or old_value != new_value):
+                    insort(index.setdefault(new_value, []), id)
+
+    def changed(self, id):
+        self.versions[id] = next(self.version_counter)
+        for listener in self.listeners:
+            listener(self.name, id)
+
+    def get_versioned(self, id):
+        with self.lock_for(id):
+            return self.records[id], self.versions[id]
+
+    # the records with the given ids, by id, ids without a record are left out
+    def get_many(self, ids):
+        records = {}
+        for id in ids:
+            record = self.records.get(id)
+            if record is not None:
+                records[id] = record
+        return records
+
+    # like get_many, with (record, version) values
+    def get_many_versioned(self, ids):
+        versioned = {}
+        for id in ids:
+            with self.lock_for(id):
+                record = self.records.get(id)
+                if record is not None:
+                    versioned[id] = (record, self.versions[id])
+        return versioned
+
+    # inserts the record only if the id is free, returns whether it was inserted
+    def add(self, id, record):
+        record = self.compact(record)
+        with self.lock_for(id):
+            if self.records.setdefault(id, record) is not record:
+                return False
+            self.ids.observe(id)
+            self.reindex(id, None, record)
+            self.changed(id)
+            return True
+
+    # applies changes (or changes(record)) to a copy of the record and swaps it in, so readers never
+    # see a partial update. Returns None without writing if condition(record) is false
+    def update(self, id, changes, condition=None):
+        with self.lock_for(id):
+            old = self.records[id]
+            if condition is not None and not condition(old):
+                return None
+            record = self.compact({**old, **(changes(old) if callable(changes) else changes)})
+            self.records[id] = record
+            self.reindex(id, old, record)
+            self.changed(id)
+            return record
+
+    def scan(self, field=None, value=None, after=-1):
+        while True:
+            with self.index_lock:
+                ids = self.sorted_ids if field is None else self.indexes[field].get(value, [])
+                start = bisect_right(ids, after)
+                chunk = ids[start:start + SCAN_CHUNK_SIZE]
+            for id in chunk:
+                record = self.records.get(id)
+                if record is not None:
+                    yield record
+            if len(chunk) < SCAN_CHUNK_SIZE:
+                return
+            after = chunk[-1]
+
+    def __getitem__(self, id):
+        return self.records[id]
+
+    def __setitem__(self, id, record):
+        record = self.compact(record)
+        with self.lock_for(id):
+            old = self.records.get(id)
+            self.records[id] = record
+            self.reindex(id, old, record)
+            self.changed(id)
+
+    def __delitem__(self, id):
+        with self.lock_for(id):
+            old = self.records.pop(id)
+            self.reindex(id, old, None)
+            self.changed(id)
+
+    def __contains__(self, id):
+        return id in self.records
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __len__(self):
+        return len(self.records)
+
+'''
+SQLiteDatabase owns the database file and hands out one connection per thread
+'''
+class SQLiteDatabase:
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+    def connection(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            # sqlite3 keeps the compiled form of every statement it has seen on the connection,
+            # so the fixed SQL strings built by the repositories are prepared only once per thread
+            conn = sqlite3.connect(self.path, timeout=30, cached_statements=256)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            self.local.conn = conn
+        return conn
+
+    # a connection must not be used on both sides of a fork, so a forked worker process
+    # drops the ones it inherited (without closing them, they still belong to the parent)
+    def after_fork(self):
+        self.local = threading.local()
+
+'''
+SQLiteRepository stores each record as JSON next to its indexed fields, shared by every
+process using the same database file
+'''
+class SQLiteRepository(MutableMapping):
+    # every process using the database file sees the same records and id sequences
+    shared = True
+    # versions are stored in the version column, so they outlive restarts
+    epoch = None
+
+    def __init__(self, database, name, seed=None):
+        self.database = database
+        self.name = name
+        self.indexed_fields = INDEXED_FIELDS[name]
+        columns = ["id", "data"] + self.indexed_fields
+        self.listeners = []
+        self.select_sql = f"SELECT data FROM {name} WHERE id = ?"
+        self.select_versioned_sql = f"SELECT data, version FROM {name} WHERE id = ?"
+        self.contains_sql = f"SELECT 1 FROM {name} WHERE id = ?"
+        self.upsert_sql = (f"INSERT INTO {name} ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)}) "
+            f"ON CONFLICT (id) DO UPDATE SET {', '.join(f'{c} = excluded.{c}' for c in columns[1:])}, version = version + 1")
+        self.delete_sql = f"DELETE FROM {name} WHERE id = ?"
+        self.insert_sql = f"INSERT INTO {name} ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})"
+        self.ids_sql = f"SELECT id FROM {name} ORDER BY id"
+        self.scan_sql = f"SELECT id, data FROM {name} WHERE id > ? ORDER BY id LIMIT ?"
+        # each index also holds the rowid, so these are answered from the index in id order
+        self.index_scan_sql = {field: f"SELECT id, data FROM {name} WHERE {field} = ? AND id > ? ORDER BY id LIMIT ?"
+            for field in self.indexed_fields}
+        self.count_sql = f"SELECT COUNT(*) FROM {name}"
+        self.next_id_sql = "UPDATE sequences SET value = value + 1 WHERE name = ? RETURNING value"
+        self.observe_id_sql = "UPDATE sequences SET value = MAX(value, ?) WHERE name = ?"
+        with self.database.connection() as conn:
+            self.create_tables(conn)
+        if seed and not len(self):
+            for id, record in seed.items():
+                self[id] = record
+        with self.database.connection() as conn:
+            conn.execute(f"INSERT OR IGNORE INTO sequences (name, value) SELECT ?, COALESCE(MAX(id), 0) FROM {name}", (name,))
+
+    def after_fork(self):
+        self.database.after_fork()
+
+    def create_tables(self, conn):
+        conn.execute("CREATE TABLE IF NOT EXISTS sequences (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        indexed_columns = "".join(f", {field} INTEGER" for field in self.indexed_fields)
+        conn.execute(f"CREATE TABLE IF NOT EXISTS {self.name} (id INTEGER PRIMARY KEY, data TEXT NOT NULL, "
+            f"version INTEGER NOT NULL DEFAULT 1{indexed_columns})")
+        for field in self.indexed_fields:
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {self.name}_{field} ON {self.name} ({field})")
+
+    def encode(self, record):
+        return json.dumps(record)
+
+    def decode(self, id, data):
+        return json.loads(data)
+
+    def __getitem__(self, id):
+        row = self.database.connection().execute(self.select_sql, (id,)).fetchone()
+        if row is None:
+            raise KeyError(id)
+        return self.decode(id, row[0])
+
+    def get_versioned(self, id):
+        row = self.database.connection().execute(self.select_versioned_sql, (id,)).fetchone()
+        if row is None:
+            raise KeyError(id)
+        return self.decode(id, row[0]), row[1]
+
+    # one query per GET_MANY_CHUNK_SIZE ids
+    def get_many(self, ids):
+        return {id: record for id, (record, _) in self.get_many_versioned(ids).items()}
+
+    def get_many_versioned(self, ids):
+        ids = list(ids)
+        versioned = {}
+        conn = self.database.connection()
+        for start in range(0, len(ids), GET_MANY_CHUNK_SIZE):
+            chunk = ids[start:start + GET_MANY_CHUNK_SIZE]
+            rows = conn.execute(f"SELECT id, data, version FROM {self.name} WHERE id IN ({', '.join('?' for _ in chunk)})", chunk).fetchall()
+            records = self.decode_many([(id, data) for id, data, _ in rows])
+            versioned.update((id, (records[id], version)) for id, _, version in rows)
+        return versioned
+
+    def decode_many(self, rows):
+        return {id: self.decode(id, data) for id, data in rows}
+
+    def changed(self, id):
+        for listener in self.listeners:
+            listener(self.name, id)
+
+    def __setitem__(self, id, record):
+        with self.database.connection() as conn:
+            self.write(conn, id, record)
+        self.changed(id)
+
+    def write(self, conn, id, record, sql=None):
+        conn.execute(sql or self.upsert_sql, (id, self.encode(record), *(record.get(f) for f in self.indexed_fields)))
+
+    # the sequence row is shared by every process using the database
+    def next_id(self):
+        with self.database.connection() as conn:
+            return conn.execute(self.next_id_sql, (self.name,)).fetchone()[0]
+
+    def add(self, id, record):
+        try:
+            with self.database.connection() as conn:
+                self.write(conn, id, record, self.insert_sql)
+                conn.execute(self.observe_id_sql, (id, self.name))
+        except sqlite3.IntegrityError:
+            return False
+        self.changed(id)
+        return True
+
+    # BEGIN IMMEDIATE takes the write lock before reading, so concurrent updates (and processes)
+    # can't interleave between the condition check and the write
+    def update(self, id, changes, condition=None):
+        with self.database.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(self.select_sql, (id,)).fetchone()
+            if row is None:
+                raise KeyError(id)
+            old = self.decode(id, row[0])
+            if condition is not None and not condition(old):
+                return None
+            record = {**old, **(changes(old) if callable(changes) else changes)}
+            self.write(conn, id, record)
+        self.changed(id)
+        return record
+
+    def __delitem__(self, id):
+        with self.database.connection() as conn:
+            if conn.execute(self.delete_sql, (id,)).rowcount == 0:
+                raise KeyError(id)
+        self.changed(id)
+
+    def __contains__(self, id):
+        return self.database.connection().execute(self.contains_sql, (id,)).fetchone() is not None
+
+    def scan(self, field=None, value=None, after=-1):
+        while True:
+            if field is None:
+                rows = self.database.connection().execute(self.scan_sql, (after, SCAN_CHUNK_SIZE)).fetchall()
+            else:
+                rows = self.database.connection().execute(self.index_scan_sql[field], (value, after, SCAN_CHUNK_SIZE)).fetchall()
+            for id, data in rows:
+                yield self.decode(id, data)
+            if len(rows) < SCAN_CHUNK_SIZE:
+                return
+            after = rows[-1][0]
+
+    def __iter__(self):
+        return iter([row[0] for row in self.database.connection().execute(self.ids_sql)])
+
+    def __len__(self):
+        return self.database.connection().execute(self.count_sql).fetchone()[0]
+
+'''
+PickupSQLiteRepository keeps batteries in their own normalized table, one row per battery
+'''
+class PickupSQLiteRepository(SQLiteRepository):
+    def __init__(self, database, name, seed=None):
+        self.batteries_select_sql = f"SELECT {', '.join(BATTERY_FIELDS)} FROM batteries WHERE pickupId = ? ORDER BY position"
+        self.batteries_insert_sql = (f"INSERT INTO batteries (pickupId, position, {', '.join(BATTERY_FIELDS)}) "
+            f"VALUES (?, ?, {', '.join('?' for _ in BATTERY_FIELDS)})")
+        self.batteries_delete_sql = "DELETE FROM batteries WHERE pickupId = ?"
+        super().__init__(database, name, seed)
+
+    def create_tables(self, conn):
+        super().create_tables(conn)
+        # columns are left untyped so numbers and strings come back exactly as they were stored
+        conn.execute(f"CREATE TABLE IF NOT EXISTS batteries (pickupId INTEGER NOT NULL REFERENCES {self.name} (id) ON DELETE CASCADE, "
+            f"position INTEGER NOT NULL, {', '.join(BATTERY_FIELDS)}, PRIMARY KEY (pickupId, position))")
+        conn.execute("CREATE INDEX IF NOT EXISTS batteries_ownerId ON batteries (ownerId)")
+
+    def encode(self, record):
+        return json.dumps({k: v for k, v in record.items() if k != "batteries"})
+
+    def decode(self, id, data):
+        record = json.loads(data)
+        record["batteries"] = [self.decode_battery(row) for row in self.database.connection().execute(self.batteries_select_sql, (id,))]
+        return record
+
+    # batteries of all the pickups are read with one query
+    def decode_many(self, rows):
+        records = {id: json.loads(data) for id, data in rows}
+        for record in records.values():
+            record["batteries"] = []
+        if records:
+            sql = (f"SELECT pickupId, {', '.join(BATTERY_FIELDS)} FROM batteries "
+                f"WHERE pickupId IN ({', '.join('?' for _ in records)}) ORDER BY pickupId, position")
+            for row in self.database.connection().execute(sql, list(records)):
+                records[row[0]]["batteries"].append(self.decode_battery(row[1:]))
+        return records
+
+    def decode_battery(self, row):
+        battery = dict(zip(BATTERY_FIELDS, row))
+        battery["isFunctioning"] = bool(battery["isFunctioning"])
+        if battery["comments"] is None:
+            del battery["comments"]
+        return battery
+
+    def write(self, conn, id, record, sql=None):
+        super().write(conn, id, record, sql)
+        conn.execute(self.batteries_delete_sql, (id,))
+        conn.executemany(self.batteries_insert_sql,
+            ((id, position, *(b.get(f) for f in BATTERY_FIELDS)) for position, b in enumerate(record["batteries"])))
+
+SQLITE_REPOSITORIES = {
+    "pickups": PickupSQLiteRepository,
+}
+
+# builds the repositories named in INDEXED_FIELDS for the configured backend
+def create_repositories(backend, seeds, sqlite_path=None, compact_records=False):
+    if backend == "memory":
+        return {name: InMemoryRepository(name, seeds.get(name), compact_records) for name in INDEXED_FIELDS}
+    if backend == "sqlite":
+        database = SQLiteDatabase(sqlite_path)
+        return {name: SQLITE_REPOSITORIES.get(name, SQLiteRepository)(database, name, seeds.get(name)) for name in INDEXED_FIELDS}
+    raise ValueError(f"Unknown repository backend: {backend}")
@@ -0,0 +1,203 @@
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import threading
+from expiry import is_expired
+
+"""
+Re-pricing of open quotes after a new QuoteConfig. Open quotes are grouped by the config they were
+priced with, the new config is diffed against each group's config, and a dependency index from
+pricing inputs (brand/model MSRP entries and chemistries) to open quotes finds the quotes of the
+group that can change. Only those are re-priced, in a background pool,
+with progress written to a job record.
+"""
+
+MISSING = object()
+REQUOTE_CHUNK_SIZE = 50
+
+# quotes approved since the job started keep their agreed price, expired ones their last
+def is_open(quote, now):
+    return not quote["isApproved"] and not is_expired(quote, now)
+
+# pricing inputs a battery's price depends on, matching QuoteCalculator.calculate_battery_base_price
+def battery_keys(battery):
+    brand = battery["brand"] or battery["vehicleMake"]
+    model = battery["model"] or battery["vehicleModel"]
+    return [("model", brand, model), ("chemistry", battery["chemistry"])]
+
+def changed_entries(old, new):
+    return [k for k in old.keys() | new.keys() if old.get(k, MISSING) != new.get(k, MISSING)]
+
+# returns the changed pricing keys, and whether the weights changed (which affects every quote)
+def diff_configs(old, new):
+    keys = set()
+    old_MSRPs, new_MSRPs = old["batteryModelMSRPs"], new["batteryModelMSRPs"]
+    for brand in old_MSRPs.keys() | new_MSRPs.keys():
+        for model in changed_entries(old_MSRPs.get(brand) or {}, new_MSRPs.get(brand) or {}):
+            keys.add(("model", brand, model))
+    for chemistry in changed_entries(old["batteryChemistryCostPerkWh"], new["batteryChemistryCostPerkWh"]):
+        keys.add(("chemistry", chemistry))
+    weights_changed = old["batteryPropsWeights"] != new["batteryPropsWeights"]
+    return keys, weights_changed
+
+'''
+QuoteDependencyIndex maps pricing keys to the open quotes whose batteries use them, and configs
+to the open quotes priced with them. It is built from the repositories on first use and kept up
+to date as quotes are issued, re-priced and approved
+'''
+class QuoteDependencyIndex:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.built = False
+        self.quotes_by_key = {}
+        self.keys_by_quote = {}
+        self.quotes_by_config = {}
+        self.config_by_quote = {}
+
+    def build(self, quotes, pickups):
+        with self.lock:
+            if self.built:
+                return
+            for quote in quotes.scan():
+                if not quote["isApproved"] and not is_expired(quote) and quote["associatedPickupId"] in pickups:
+                    self.index(quote["id"], pickups[quote["associatedPickupId"]]["batteries"], quote.get("quoteConfigId"))
+            self.built = True
+
+    # forgets everything, the next build() reads the repositories again
+    def reset(self):
+        with self.lock:
+            self.built = False
+            self.quotes_by_key.clear()
+            self.keys_by_quote.clear()
+            self.quotes_by_config.clear()
+            self.config_by_quote.clear()
+
+    # (re)indexes a quote, e.g. under the config it was re-priced with
+    def index(self, quote_id, batteries, config_id):
+        self.unindex(quote_id)
+        keys = {k for b in batteries for k in battery_keys(b)}
+        self.keys_by_quote[quote_id] = keys
+        for k in keys:
+            self.quotes_by_key.setdefault(k, set()).add(quote_id)
+        self.config_by_quote[quote_id] = config_id
+        self.quotes_by_config.setdefault(config_id, set()).add(quote_id)
+
+    def unindex(self, quote_id):
+        for k in self.keys_by_quote.pop(quote_id, ()):
+            quote_ids = self.quotes_by_key[k]
+            quote_ids.discard(quote_id)
+            if not quote_ids:
+                del self.quotes_by_key[k]
+        if quote_id in self.config_by_quote:
+            config_id = self.config_by_quote.pop(quote_id)
+            quote_ids = self.quotes_by_config[config_id]
+            quote_ids.discard(quote_id)
+            if not quote_ids:
+                del self.quotes_by_config[config_id]
+
+    def add(self, quote_id, batteries, config_id):
+        with self.lock:
+            if self.built:
+                self.index(quote_id, batteries, config_id)
+
+    def remove(self, quote_id):
+        with self.lock:
+            self.unindex(quote_id)
+
+    # open quotes whose price can change under new_config, each diffed against the config it was
+    # priced with. config_of(config_id) returns a config, quotes of configs it raises KeyError for
+    # are all affected
+    def affected(self, new_config, config_of):
+        affected = set()
+        with self.lock:
+            for config_id, quote_ids in self.quotes_by_config.items():
+                if config_id == new_config["id"]:
+                    continue
+                try:
+                    keys, weights_changed = diff_configs(config_of(config_id), new_config)
+                except KeyError:
+                    keys, weights_changed = (), True
+                if weights_changed:
+                    affected |= quote_ids
+                    continue
+                affected |= {quote_id for k in keys for quote_id in self.quotes_by_key.get(k, ()) if quote_id in quote_ids}
+        return sorted(affected)
+
+'''
+Requoter runs re-pricing jobs on a thread pool. price_batteries(calculator, pickup, now) is the
+same pricing function quotes are issued with, and listeners are called with every re-priced
+quote, the pickup's batteries and their new prices
+'''
+class Requoter:
+    def __init__(self, quotes, pickups, jobs, price_batteries, workers):
+        self.quotes = quotes
+        self.pickups = pickups
+        self.jobs = jobs
+        self.price_batteries = price_batteries
+        self.listeners = []
+        self.index = QuoteDependencyIndex()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="requote")
+
+    # creates the job record and queues the affected quotes, returns the job. config_of(config_id)
+    # returns the config open quotes were priced with
+    def start(self, new_config, calculator, config_of):
+        # quotes issued and approved by other processes don't reach this index, so with a shared
+        # repository it is rebuilt from the records every time
+        if self.quotes.shared:
+            self.index.reset()
+        self.index.build(self.quotes, self.pickups)
+        quote_ids = self.index.affected(new_config, config_of)
+
+        now = datetime.datetime.now()
+        job = {
+            "id": self.jobs.next_id(),
+            "type": "requote",
+            "status": "running" if quote_ids else "done",
+            "configId": new_config["id"],
+            "total": len(quote_ids),
+            "completed": 0,
+            "failed": 0,
+            "createdAt": now.isoformat(),
+            "updatedAt": now.isoformat(),
+        }
+        self.jobs.add(job["id"], job)
+
+        progress = {"completed": 0, "failed": 0, "pending": 0, "lock": threading.Lock()}
+        chunks = [quote_ids[i:i + REQUOTE_CHUNK_SIZE] for i in range(0, len(quote_ids), REQUOTE_CHUNK_SIZE)]
+        progress["pending"] = len(chunks)
+        for chunk in chunks:
+            self.executor.submit(self.requote_chunk, job["id"], chunk, new_config["id"], calculator, now, progress)
+        return job
+
+    def requote_chunk(self, job_id, quote_ids, config_id, calculator, now, progress):
+        completed = failed = 0
+        for quote_id in quote_ids:
+            try:
+                quote = self.quotes[quote_id]
+                if is_open(quote, now):
+                    pickup = self.pickups[quote["associatedPickupId"]]
+                    prices = self.price_batteries(calculator, pickup, now)
+                    # checked again under the record's lock, an agreement may have come in meanwhile. The
+                    # timestamp is taken there as well, so updatedAt never goes back past concurrent writes
+                    quote = self.quotes.update(quote_id,
+                        lambda current: {"quotePrice": sum(prices), "quoteConfigId": config_id, "updatedAt": datetime.datetime.now().isoformat()},
+                        lambda current: is_open(current, now))
+                    if quote is not None:
+                        self.index.add(quote_id, pickup["batteries"], config_id)
+                        for listener in self.listeners:
+                            listener(quote, pickup["batteries"], prices)
+                completed += 1
+            except Exception:
+                failed += 1
+
+        with progress["lock"]:
+            progress["completed"] += completed
+            progress["failed"] += failed
+            progress["pending"] -= 1
+            changes = {
+                "completed": progress["completed"],
+                "failed": progress["failed"],
+                "updatedAt": datetime.datetime.now().isoformat(),
+            }
+            if not progress["pending"]:
+                changes["status"] = "failed" if progress["failed"] else "done"
+            self.jobs.update(job_id, changes)
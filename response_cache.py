@@ -0,0 +1,43 @@
+from collections import OrderedDict
+import threading
+
+"""
+Response cache keeps the already-encoded body of recently read records, so GETs of records that
+haven't changed skip serialization. Entries are stored per (repository name, id) with the record
+version they were encoded from, and are only served while that version is still current.
+"""
+
+'''
+ResponseCache is a thread-safe LRU of encoded response bodies
+'''
+class ResponseCache:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, version, body):
+        if not self.max_entries:
+            return
+        with self.lock:
+            self.entries[key] = (version, body)
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    # repository listener, called with (repository name, id) on every write
+    def invalidate(self, name, id):
+        with self.lock:
+            self.entries.pop((name, id), None)
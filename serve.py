@@ -0,0 +1,119 @@
+import argparse
+import os
+import signal
+import socket
+import sys
+
+"""
+Production entry point: `python serve.py --workers 8 --bind 0.0.0.0:8000`. The app is imported
+once and forked into one worker process per core, so quoting (CPU-bound Python) is not limited
+to a single core by the GIL. Workers share records and id sequences through the sqlite backend,
+which is the default here. Runs under gunicorn when it is installed, otherwise on a pre-forked
+pool of werkzeug servers accepting on the same socket. The parent only supervises the workers, it
+stops the app's background work before forking. A single worker is served in this process.
+"""
+
+def parse_bind(bind):
+    host, _, port = bind.rpartition(":")
+    return host or "0.0.0.0", int(port)
+
+def serve_gunicorn(main, args):
+    from gunicorn.app.base import BaseApplication
+
+    class Application(BaseApplication):
+        def load_config(self):
+            self.cfg.set("bind", args.bind)
+            self.cfg.set("workers", args.workers)
+            self.cfg.set("threads", args.threads)
+            self.cfg.set("worker_class", "gthread")
+            self.cfg.set("preload_app", True)
+            self.cfg.set("pre_fork", lambda server, worker: main.before_fork())
+            self.cfg.set("post_fork", lambda server, worker: main.after_fork())
+
+        def load(self):
+            return main.app
+
+    Application().run()
+
+def serve_single(main, args):
+    from werkzeug.serving import make_server
+
+    host, port = parse_bind(args.bind)
+    print(f"Serving on http://{host}:{port} in this process", file=sys.stderr)
+    try:
+        make_server(host, port, main.app, threaded=True).serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+def serve_prefork(main, args):
+    from werkzeug.serving import make_server
+
+    host, port = parse_bind(args.bind)
+    listener = socket.create_server((host, port), backlog=2048)
+    listener.set_inheritable(True)
+
+    def spawn():
+        pid = os.fork()
+        if pid:
+            return pid
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        try:
+            main.after_fork()
+            make_server(host, port, main.app, threaded=True, fd=listener.fileno()).serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os._exit(0)
+
+    def terminate(signum, frame):
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, terminate)
+    main.before_fork()
+    workers = {spawn() for _ in range(args.workers)}
+    print(f"Serving on http://{host}:{port} with {args.workers} worker processes", file=sys.stderr)
+    try:
+        # workers that die are replaced
+        while True:
+            pid, _ = os.wait()
+            workers.discard(pid)
+            workers.add(spawn())
+    except (KeyboardInterrupt, SystemExit):
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in workers:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the API with one worker process per core")
+    parser.add_argument("--bind", default="0.0.0.0:8000", help="host:port to listen on")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Number of worker processes")
+    parser.add_argument("--threads", type=int, default=4, help="Threads per worker (gunicorn only)")
+    args = parser.parse_args()
+
+    # set before the app is imported, it reads its settings at import
+    os.environ.setdefault("BATTERIA_REPOSITORY_BACKEND", "sqlite")
+    import main
+
+    if args.workers > 1 and not main.users.shared:
+        sys.exit("The memory backend is per process, use BATTERIA_REPOSITORY_BACKEND=sqlite with more than one worker")
+
+    if args.workers < 1:
+        sys.exit("--workers must be at least 1")
+
+    try:
+        import gunicorn
+    except ImportError:
+        gunicorn = None
+    if args.workers == 1:
+        serve_single(main, args)
+    elif gunicorn is not None:
+        serve_gunicorn(main, args)
+    else:
+        serve_prefork(main, args)
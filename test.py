@@ -1,4 +1,5 @@
 import requests
+import json
 # NOTE: must run `python main.py` before running `python test.py`
 BASE_URL = "http://127.0.0.1:5000/"
 
@@ -138,6 +139,41 @@ print("GET Response")
 print(response.status_code, response.content)
 print()
 
+print("Bulk POST Request (one pickup per line, second line expected to fail validation)")
+bulk_pickup = {
+        "ownerId": 1,
+        "pickUpAddress": "123 Gravy Ln",
+        "batteries": [
+            {   "chemistry": "NiMH",
+                "batteryType": "BatteryBackup",
+                "ownerId": 1,
+                "brand": None,
+                "model": None,
+                "vehicleMake": None,
+                "vehicleModel": None,
+                "weightLbs": 12,
+                "inputVoltage": 120,
+                "outputVoltage": 120,
+                "markedCapacitykWh": 2,
+                "approxLengthUsedDays": 900,
+                "dateOriginallyPurchased": "2020-05-01",
+                "isFunctioning": False,
+                "conditionOriginallyPurchased": "Used"
+            }
+        ],
+        "addressType": "Residential",
+        "requestedPickupDate": "2021-01-01 23:26:08.712542"
+    }
+response = requests.post(BASE_URL + "pickups/bulk",
+data="\n".join([
+    json.dumps({**bulk_pickup, "id": 100}),
+    json.dumps({**bulk_pickup, "id": 101, "addressType": "Boat"})
+]),
+headers={'Content-type': 'application/x-ndjson'})
+print("Bulk POST Response")
+print(response.status_code, response.content)
+print()
+
 print("Quotes............................................................")
 
 print("GET Request")
@@ -167,6 +203,52 @@ print("GET Response")
 print(response.status_code, response.content)
 print()
 
+print("GET Request (agreement with its quote, pickup and owner, without the batteries)")
+response = requests.get(BASE_URL + "agreement/" + str(2), params={
+    "expand": "associatedQuote.associatedPickup.owner",
+    "fields": "id,agreedDate,associatedQuote.quotePrice,associatedQuote.associatedPickup.pickUpAddress,associatedQuote.associatedPickup.owner"})
+print("GET Response")
+print(response.status_code, response.content)
+print()
+
+print("Lists............................................................")
+
+print("GET Request (pickups of owner 1, two per page)")
+response = requests.get(BASE_URL + "pickups", params={"ownerId": 1, "limit": 2})
+print("GET Response")
+print(response.status_code, response.content)
+print()
+
+print("GET Request (next page)")
+response = requests.get(BASE_URL + "pickups", params={"ownerId": 1, "limit": 2, "after": response.json()["nextCursor"]})
+print("GET Response")
+print(response.status_code, response.content)
+print()
+
+print("GET Request (approved quotes of seller 1)")
+response = requests.get(BASE_URL + "quotes", params={"sellerId": 1, "isApproved": "true"})
+print("GET Response")
+print(response.status_code, response.content)
+print()
+
+print("GET Request (agreement for quote 2)")
+response = requests.get(BASE_URL + "agreements", params={"associatedQuoteId": 2})
+print("GET Response")
+print(response.status_code, response.content)
+print()
+
+print("GET Request (quotes 1, 2 and 999 at once)")
+response = requests.get(BASE_URL + "quotes", params={"ids": "1,2,999"})
+print("GET Response")
+print(response.status_code, response.content)
+print()
+
+print("POST Request (users 1 and 2 at once)")
+response = requests.post(BASE_URL + "users:batchGet", json={"ids": [1, 2]}, headers=headers)
+print("POST Response")
+print(response.status_code, response.content)
+print()
+
 print("Quote Configs............................................................")
 
 print("POST Request")
@@ -210,4 +292,159 @@ print("GET Request")
 response = requests.get(BASE_URL + "quoteConfig/" + str(2)) 
 print("GET Response")
 print(response.status_code, response.content)
-print()
\ No newline at end of file
+print()
+print("GET Request (active config, config 2 became active when it was posted)")
+response = requests.get(BASE_URL + "quoteConfig/active")
+print("GET Response")
+print(response.status_code, response.content)
+print()
+
+print("PUT Request (roll back to config 1)")
+response = requests.put(BASE_URL + "quoteConfig/active", json={"quoteConfigId": 1}, headers=headers)
+print("PUT Response")
+print(response.status_code, response.content)
+print()
+
+print("Analytics............................................................")
+print()
+
+print("GET Request (quoted and approved value by chemistry and week)")
+response = requests.get(BASE_URL + "analytics/quotes?groupBy=chemistry,week")
+print("GET Response")
+print(response.status_code, response.content)
+print()
+
+print("GET Request (unknown dimension, 400 Bad Request Expected)")
+response = requests.get(BASE_URL + "analytics/quotes?groupBy=color")
+print("GET Response")
+print(response.status_code, response.content)
+print()
+
+print("GET Request (quotes that can no longer be agreed to)")
+response = requests.get(BASE_URL + "quotes?isExpired=true")
+print("GET Response")
+print(response.status_code, response.content)
+print()
+
+print("Pricing simulation...................................................")
+print()
+
+print("POST Request (pickup 1 and an inline battery under configs 1 and 2, nothing is stored)")
+response = requests.post(BASE_URL + "pricing/simulate",
+json={
+    "pickupIds": [1],
+    "batteries": [{
+        "chemistry": "NiMH",
+        "batteryType": "BatteryBackup",
+        "ownerId": 1,
+        "brand": None,
+        "model": None,
+        "vehicleMake": None,
+        "vehicleModel": None,
+        "weightLbs": 10,
+        "inputVoltage": 12,
+        "outputVoltage": 12,
+        "markedCapacitykWh": 1,
+        "approxLengthUsedDays": 100,
+        "dateOriginallyPurchased": "2021-01-01 23:26:08.712542",
+        "isFunctioning": True,
+        "conditionOriginallyPurchased": "Used",
+        "comments": "spare"
+    }],
+    "quoteConfigIds": [1, 2]
+},
+headers=headers)
+print("POST Response")
+print(response.status_code, response.content)
+print()
+
+print("Conditional GETs.....................................................")
+print()
+
+print("GET Request (quote of bulk pickup 100, keeping its ETag)")
+quote_id = requests.get(BASE_URL + "quotes", params={"associatedPickupId": 100}).json()["items"][0]["id"]
+response = requests.get(BASE_URL + "quote/" + str(quote_id))
+etag = response.headers["ETag"]
+body = response.content
+print("GET Response")
+print(response.status_code, etag, response.content)
+assert response.status_code == 200 and etag
+print()
+
+print("GET Request (same quote again, same ETag and body expected, served from the response cache)")
+response = requests.get(BASE_URL + "quote/" + str(quote_id))
+print("GET Response")
+print(response.status_code, response.headers["ETag"])
+assert response.status_code == 200 and response.headers["ETag"] == etag and response.content == body
+print()
+
+print("GET Request (If-None-Match with that ETag, 304 Not Modified Expected)")
+response = requests.get(BASE_URL + "quote/" + str(quote_id), headers={"If-None-Match": etag})
+print("GET Response")
+print(response.status_code, response.headers["ETag"], response.content)
+assert response.status_code == 304 and response.headers["ETag"] == etag and not response.content
+print()
+
+print("GET Request (If-None-Match with that ETag but ?fields=id, 200 Expected, it is another representation)")
+response = requests.get(BASE_URL + "quote/" + str(quote_id), params={"fields": "id"}, headers={"If-None-Match": etag})
+print("GET Response")
+print(response.status_code, response.headers["ETag"], response.content)
+assert response.status_code == 200 and response.headers["ETag"] != etag
+print()
+
+print("POST Request (agreeing to the quote approves it)")
+response = requests.post(BASE_URL + "agreement/" + str(100),
+json={
+        "associatedQuoteId": quote_id,
+        "agreedDate": "2021-01-01 23:26:08.712542",
+        "paymentMethod": "Check"
+    },
+headers=headers)
+print("POST Response")
+print(response.status_code, response.content)
+assert response.status_code == 201
+print()
+
+print("GET Request (If-None-Match with the old ETag, 200 Expected with the approved quote and a new ETag)")
+response = requests.get(BASE_URL + "quote/" + str(quote_id), headers={"If-None-Match": etag})
+print("GET Response")
+print(response.status_code, response.headers["ETag"], response.content)
+assert response.status_code == 200 and response.headers["ETag"] != etag and response.json()["isApproved"]
+print()
+
+print("Price equivalence (in process, no server needed).....................")
+print()
+
+import datetime
+import batch_pricing
+import records
+from benchmark import SyntheticData
+from price_cache import PriceCache
+from quote_calculator import QuoteCalculator
+
+# every pricing engine must give every battery exactly the scalar QuoteCalculator price
+print("Scalar, cached, compact and batch (when numpy is installed) prices of 30 synthetic pickups of 200 batteries")
+now = datetime.datetime(2026, 1, 1)
+for seed in range(30):
+    data = SyntheticData(seed)
+    calculator = QuoteCalculator(data.config())
+    pickup = data.pickup(200)
+    compact_pickup = {"batteries": records.compact_batteries(pickup["batteries"])}
+    scalar = calculator.battery_prices(pickup, now)
+    price_cache = PriceCache(1000)
+    engines = {
+        "cached (miss)": price_cache.battery_prices(calculator, pickup, now),
+        "cached (hit)": price_cache.battery_prices(calculator, pickup, now),
+        "compact": calculator.battery_prices(compact_pickup, now),
+        "compact cached": price_cache.battery_prices(calculator, compact_pickup, now),
+    }
+    if batch_pricing.is_available():
+        engines["batch"] = batch_pricing.battery_prices(calculator, pickup["batteries"], now).tolist()
+        engines["compact batch"] = batch_pricing.battery_prices(calculator, compact_pickup["batteries"], now).tolist()
+        engines["batch total"] = [batch_pricing.final_quote_price(calculator, pickup, now)]
+    for engine, prices in engines.items():
+        expected = [sum(scalar)] if engine == "batch total" else scalar
+        assert prices == expected, f"{engine} prices differ from the scalar prices for seed {seed}"
+    assert price_cache.hits and price_cache.misses
+print("Prices match for", ", ".join(["scalar"] + list(engines)))
+print()